@@ -0,0 +1,91 @@
+"""
+Throughput and latency of ShogiModelAPI for several prediction_batch_size / prediction_max_wait settings, with
+clients that each send one observation at a time like the search threads do. The network is replaced by a sleep
+with a fixed cost per batch plus a cost per observation, roughly the shape of CPU inference.
+
+    python scripts/bench_batching.py
+"""
+import multiprocessing as mp
+import os
+import sys
+from time import sleep
+from timeit import default_timer as timer
+
+import numpy as np
+
+_PATH_ = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+if _PATH_ not in sys.path:
+    sys.path.append(_PATH_)
+
+from shogi_zero.agent.api_shogi import ShogiModelAPI  # noqa: E402
+from shogi_zero.agent.player_shogi import canonical_labels  # noqa: E402
+from shogi_zero.config import Config  # noqa: E402
+from shogi_zero.env.shogi_env import ShogiEnv  # noqa: E402
+
+BATCH_COST = 0.002  # seconds per batch
+OBSERVATION_COST = 0.0001  # seconds per observation
+SEARCH_TIME = 0.002  # seconds a client works between two requests
+NUM_CLIENTS = 16
+DURATION = 3.0
+SETTINGS = [(1, 0), (16, 0), (16, 0.001), (16, 0.002), (16, 0.005)]  # (prediction_batch_size, prediction_max_wait)
+
+
+class SlowNetwork:
+    def __init__(self, n_labels):
+        self.n_labels = n_labels
+
+    def predict_on_batch(self, data):
+        sleep(BATCH_COST + OBSERVATION_COST * len(data))
+        policy = np.full((len(data), self.n_labels), 1 / self.n_labels, dtype=np.float32)
+        return policy, np.zeros(len(data), dtype=np.float32)
+
+
+class SlowModel:
+    def __init__(self, config):
+        self.config = config
+        self.model = self.predict_model = SlowNetwork(config.n_labels)
+        self.digest = "slow"
+        self.session = None
+
+
+def client(pipe, request, duration, results):
+    num = 0
+    start = timer()
+    while timer() - start < duration:
+        sleep(SEARCH_TIME)
+        pipe.send(request)
+        pipe.recv()
+        num += 1
+    results.put(num)
+
+
+def main():
+    env = ShogiEnv().reset()
+    _, legal = env.legal_moves_and_labels()
+    request = (env.canonical_input_planes(), canonical_labels(env, legal))
+
+    for batch_size, max_wait in SETTINGS:
+        config = Config("mini")
+        config.play.prediction_batch_size = batch_size
+        config.play.prediction_max_wait = max_wait
+        api = ShogiModelAPI(SlowModel(config))
+        api.start()
+        pipes = [api.create_shared_memory_pipe(1) for _ in range(NUM_CLIENTS)]
+
+        results = mp.Queue()
+        clients = [mp.Process(target=client, args=(pipe, request, DURATION, results)) for pipe in pipes]
+        for c in clients:
+            c.start()
+        num = sum(results.get() for _ in clients)
+        for c in clients:
+            c.join()
+
+        stats = api.batch_stats.summary()
+        round_trip = NUM_CLIENTS * DURATION / num - SEARCH_TIME
+        print(f"batch size {batch_size:2} max wait {max_wait * 1000:3.0f}ms: {num / DURATION:7.0f} observations/s "
+              f"round trip {round_trip * 1000:5.2f}ms | mean batch {stats['mean_size']:5.1f} "
+              f"queue wait {stats['queue_wait'] * 1000:5.2f}ms model time {stats['model_time'] * 1000:5.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
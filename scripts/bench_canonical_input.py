@@ -0,0 +1,84 @@
+"""
+Microbenchmark of the batch and board canonical input encoders against CanonicalInput.create().
+
+    python scripts/bench_canonical_input.py
+"""
+import os
+import random
+import sys
+from glob import glob
+from timeit import default_timer as timer
+
+import numpy as np
+import shogi.KIF
+
+_PATH_ = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+if _PATH_ not in sys.path:
+    sys.path.append(_PATH_)
+
+from shogi_zero.env.shogi_env import SfenInfo, CanonicalInput  # noqa: E402
+
+
+def kif_sfens(num):
+    """
+    :param int num: number of positions to collect
+    :return list(str): every position seen in the kif files of scripts/kif
+    """
+    kif_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "kif")
+    sfens = []
+    for filename in sorted(glob(os.path.join(kif_dir, "*.kif"))):
+        for kif in shogi.KIF.Parser.parse_file(filename):
+            board = shogi.Board()
+            for move in kif["moves"]:
+                sfens.append(board.sfen())
+                board.push_usi(move)
+            if len(sfens) >= num:
+                return sfens[:num]
+    return sfens
+
+
+def main(num=20000):
+    sfens = kif_sfens(num)
+    boards = [shogi.Board(sfen) for sfen in sfens]
+    sfen_infos = []
+    for sfen in sfens:
+        sfen_info = SfenInfo(sfen)
+        if sfen_info.turn == 'w':
+            sfen_info = sfen_info.get_flipped_sfen_info()
+        sfen_infos.append(sfen_info)
+    counts = [random.randint(1, 3) for _ in sfen_infos]
+
+    start = timer()
+    expected = np.asarray([CanonicalInput(info, c).create() for info, c in zip(sfen_infos, counts)])
+    loop_time = timer() - start
+
+    start = timer()
+    actual = CanonicalInput.create_batch(sfen_infos, counts)
+    batch_time = timer() - start
+
+    assert np.array_equal(expected, actual)
+
+    start = timer()
+    for board, c in zip(boards, counts):
+        info = SfenInfo(board.sfen())
+        if info.turn == 'w':
+            info = info.get_flipped_sfen_info()
+        CanonicalInput(info, c).create()
+    sfen_time = timer() - start
+
+    start = timer()
+    actual = np.asarray([CanonicalInput.create_from_board(board, c) for board, c in zip(boards, counts)])
+    board_time = timer() - start
+
+    assert np.array_equal(expected, actual)
+    print(f"positions: {len(sfen_infos)}")
+    print(f"CanonicalInput.create      : {loop_time * 1e6 / len(sfen_infos):8.1f} us/position")
+    print(f"CanonicalInput.create_batch: {batch_time * 1e6 / len(sfen_infos):8.1f} us/position "
+          f"({loop_time / batch_time:.1f}x)")
+    print(f"board -> SFEN -> create    : {sfen_time * 1e6 / len(sfen_infos):8.1f} us/position")
+    print(f"create_from_board          : {board_time * 1e6 / len(sfen_infos):8.1f} us/position "
+          f"({sfen_time / board_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
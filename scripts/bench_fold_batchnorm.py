@@ -0,0 +1,68 @@
+"""
+Checks that the predict-only model of ShogiModel.predict_only_model (batch normalizations folded into the
+convolutions, no regularizers) predicts the same as the model it comes from, and compares their latency per batch.
+The batch normalizations get random statistics first, as those of a new model would make the folding trivial.
+
+    python scripts/bench_fold_batchnorm.py [config type]
+"""
+import os
+import sys
+from timeit import default_timer as timer
+
+import numpy as np
+
+_PATH_ = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+if _PATH_ not in sys.path:
+    sys.path.append(_PATH_)
+
+from keras.layers.normalization import BatchNormalization  # noqa: E402
+
+from shogi_zero.agent.model_shogi import ShogiModel  # noqa: E402
+from shogi_zero.config import Config  # noqa: E402
+
+BATCH_SIZES = [1, 16, 64, 256]
+NUM_BATCHES = 20
+TOLERANCE = 1e-4
+
+
+def randomize_batchnorms(model, rand):
+    for layer in model.layers:
+        if isinstance(layer, BatchNormalization):
+            gamma, beta, moving_mean, moving_variance = layer.get_weights()
+            layer.set_weights([rand.uniform(0.5, 1.5, gamma.shape), rand.normal(0, 0.1, beta.shape),
+                               rand.normal(0, 0.1, moving_mean.shape), rand.uniform(0.5, 1.5, moving_variance.shape)])
+
+
+def seconds_per_batch(model, data):
+    model.predict_on_batch(data)  # warm up
+    start = timer()
+    for _ in range(NUM_BATCHES):
+        model.predict_on_batch(data)
+    return (timer() - start) / NUM_BATCHES
+
+
+def main():
+    config = Config(sys.argv[1] if len(sys.argv) > 1 else "mini")
+    rand = np.random.RandomState(0)
+    model = ShogiModel(config)
+    model.build()
+    randomize_batchnorms(model.model, rand)
+    model.model._make_predict_function()
+    predict_model = model.predict_only_model(model.model)
+
+    data = rand.randint(0, 2, size=(max(BATCH_SIZES), 44, 9, 9)).astype(np.float32)
+    policy, value = model.model.predict_on_batch(data)
+    folded_policy, folded_value = predict_model.predict_on_batch(data)
+    policy_error, value_error = np.abs(policy - folded_policy).max(), np.abs(value - folded_value).max()
+    print(f"max difference: policy {policy_error:.2e} value {value_error:.2e} "
+          f"({'ok' if max(policy_error, value_error) < TOLERANCE else 'ABOVE TOLERANCE'})")
+
+    for batch_size in BATCH_SIZES:
+        before = seconds_per_batch(model.model, data[:batch_size])
+        after = seconds_per_batch(predict_model, data[:batch_size])
+        print(f"batch {batch_size:3}: with batch normalizations {before * 1000:8.2f}ms | "
+              f"folded {after * 1000:8.2f}ms ({before / after:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Compares the array-backed VisitStats with the former dict of ActionStats objects: memory per expanded node
+and PUCT selection time per simulation.
+
+    python scripts/bench_mcts_node.py
+"""
+import os
+import sys
+import tracemalloc
+from collections import defaultdict
+from timeit import default_timer as timer
+
+import numpy as np
+import shogi
+
+_PATH_ = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+if _PATH_ not in sys.path:
+    sys.path.append(_PATH_)
+
+from shogi_zero.agent.player_shogi import VisitStats  # noqa: E402
+from shogi_zero.config import Config  # noqa: E402
+
+C_PUCT = 1.5
+NOISE_EPS = 0.25
+DIR_ALPHA = 0.3
+# a middle game position with pieces in hand, so with many legal moves
+SFEN = "ln1g3nl/1r1sgkb2/p1pppp1pp/1p4p2/7P1/2P6/PP1PPPP1P/1BG2S1R1/LN2KG1NL b SPsp 17"
+
+
+class LegacyActionStats:
+    def __init__(self):
+        self.n = 0
+        self.w = 0
+        self.q = 0
+        self.p = 0
+
+
+class LegacyVisitStats:
+    def __init__(self):
+        self.a = defaultdict(LegacyActionStats)
+        self.sum_n = 0
+
+
+def legacy_expand(node, moves, p, move_lookup):
+    tot_p = 1e-8
+    for mov in moves:
+        node.a[mov].p = p[move_lookup[mov]]
+        tot_p += node.a[mov].p
+    for a_s in node.a.values():
+        a_s.p /= tot_p
+
+
+def legacy_select(node, is_root_node):
+    xx_ = np.sqrt(node.sum_n + 1)
+    best_s = -999
+    best_a = None
+    if is_root_node:
+        noise = np.random.dirichlet([DIR_ALPHA] * len(node.a))
+    i = 0
+    for action, a_s in node.a.items():
+        p_ = a_s.p
+        if is_root_node:
+            p_ = (1 - NOISE_EPS) * p_ + NOISE_EPS * noise[i]
+            i += 1
+        b = a_s.q + C_PUCT * p_ * xx_ / (1 + a_s.n)
+        if b > best_s:
+            best_s = b
+            best_a = action
+    return best_a
+
+
+def legacy_backup(node, action, v):
+    a_s = node.a[action]
+    node.sum_n += 1
+    a_s.n += 1
+    a_s.w += v
+    a_s.q = a_s.w / a_s.n
+
+
+def select(node, is_root_node):
+    xx_ = np.sqrt(node.sum_n + 1)
+    p_ = node.prior
+    if is_root_node:
+        p_ = (1 - NOISE_EPS) * p_ + NOISE_EPS * np.random.dirichlet([DIR_ALPHA] * len(p_))
+    return int(np.argmax(node.q + C_PUCT * p_ * xx_ / (1 + node.n)))
+
+
+def backup(node, action, v):
+    node.sum_n += 1
+    node.n[action] += 1
+    node.w[action] += v
+    node.q[action] = node.w[action] / node.n[action]
+
+
+def run(node, select_fn, backup_fn, playouts, values):
+    elapsed = 0
+    for i in range(playouts):
+        start = timer()
+        action = select_fn(node, i == 0)
+        elapsed += timer() - start
+        backup_fn(node, action, values[i])
+    return elapsed
+
+
+def measure(build, select_fn, backup_fn, playouts, values, num_nodes=20):
+    """
+    :return (float, float): bytes per node once all of the playouts are backed up, and seconds per selection
+    """
+    tracemalloc.start()
+    nodes = []
+    for _ in range(num_nodes):
+        nodes.append(build())
+        run(nodes[-1], select_fn, backup_fn, playouts, values)
+    size = tracemalloc.get_traced_memory()[0] / num_nodes
+    tracemalloc.stop()
+
+    elapsed = run(build(), select_fn, backup_fn, playouts, values)
+    return size, elapsed / playouts
+
+
+def main():
+    config = Config()
+    move_lookup = {shogi.Move.from_usi(move): i for i, move in enumerate(config.labels)}
+    board = shogi.Board(SFEN)
+    moves = list(board.legal_moves)
+    p = np.random.dirichlet([1.0] * config.n_labels).astype(np.float32)
+
+    def build_legacy():
+        node = LegacyVisitStats()
+        legacy_expand(node, moves, p, move_lookup)
+        return node
+
+    def build():
+        node = VisitStats()
+        legal = np.array([move_lookup[mov] for mov in moves])
+        node.expand_edges(moves, legal, p[legal])
+        return node
+
+    print(f"legal moves: {len(moves)}")
+    for playouts in (800, 1200):
+        values = np.random.uniform(-1, 1, playouts).tolist()
+        legacy_size, legacy_time = measure(build_legacy, legacy_select, legacy_backup, playouts, values)
+        size, select_time = measure(build, select, backup, playouts, values)
+        print(f"{playouts} playouts: dict of ActionStats {legacy_size / 1024:6.1f} KiB/node "
+              f"{legacy_time * 1e6:6.1f} us/select | arrays {size / 1024:6.1f} KiB/node "
+              f"{select_time * 1e6:6.1f} us/select")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Cost of borrowing and returning a group of pipes in a self-play process, through the former Manager list and
+through the groups assigned to each process of the pool by pipe_helper.
+
+    python scripts/bench_pipe_pool.py
+"""
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import Manager
+from timeit import default_timer as timer
+
+import numpy as np
+
+_PATH_ = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+if _PATH_ not in sys.path:
+    sys.path.append(_PATH_)
+
+from shogi_zero.agent.api_shogi import ShogiModelAPI  # noqa: E402
+from shogi_zero.config import Config  # noqa: E402
+from shogi_zero.lib.pipe_helper import share_pipes, worker_pipes  # noqa: E402
+
+NUM_PROCESSES = 4
+NUM_BORROWS = 200
+
+
+class UniformNetwork:
+    def __init__(self, n_labels):
+        self.n_labels = n_labels
+
+    def predict_on_batch(self, data):
+        policy = np.full((len(data), self.n_labels), 1 / self.n_labels, dtype=np.float32)
+        return policy, np.zeros(len(data), dtype=np.float32)
+
+
+class UniformModel:
+    def __init__(self, config):
+        self.config = config
+        self.model = self.predict_model = UniformNetwork(config.n_labels)
+        self.digest = "uniform"
+        self.session = None
+
+
+def borrow_from_manager(cur):
+    start = timer()
+    for _ in range(NUM_BORROWS):
+        pipes = cur.pop()
+        cur.append(pipes)
+    return (timer() - start) / NUM_BORROWS
+
+
+def borrow_assigned():
+    start = timer()
+    for _ in range(NUM_BORROWS):
+        worker_pipes("cur")
+    return (timer() - start) / NUM_BORROWS
+
+
+def main():
+    config = Config("mini")
+    api = ShogiModelAPI(UniformModel(config))
+    api.start()
+    threads = config.play.search_threads
+    pipe_groups = [[api.create_shared_memory_pipe(threads) for _ in range(threads)] for _ in range(NUM_PROCESSES)]
+
+    cur = Manager().list(pipe_groups)
+    with ProcessPoolExecutor(max_workers=NUM_PROCESSES) as executor:
+        manager = np.mean(list(executor.map(borrow_from_manager, [cur] * NUM_PROCESSES)))
+    share_pipes({"cur": pipe_groups})
+    with ProcessPoolExecutor(max_workers=NUM_PROCESSES) as executor:
+        assigned = np.mean([executor.submit(borrow_assigned).result() for _ in range(NUM_PROCESSES)])
+    print(f"{NUM_PROCESSES} processes, {threads} pipes per group: manager list {manager * 1e6:8.1f} us/borrow | "
+          f"assigned {assigned * 1e6:6.2f} us/borrow")
+
+
+if __name__ == "__main__":
+    main()
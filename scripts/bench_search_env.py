@@ -0,0 +1,92 @@
+"""
+Compares the per simulation cost of walking down the search tree on a copy of the environment (env.copy() then
+env.step) with walking down and back on one environment (env.push then env.pop), early and late in a game.
+
+    python scripts/bench_search_env.py
+"""
+import os
+import random
+import sys
+from timeit import default_timer as timer
+
+_PATH_ = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+if _PATH_ not in sys.path:
+    sys.path.append(_PATH_)
+
+from shogi_zero.env.shogi_env import ShogiEnv  # noqa: E402
+
+DEPTH = 8  # moves played by a simulation before it reaches a leaf
+NUM_SIMULATIONS = 2000
+
+
+def random_game(num_moves, seed=0):
+    """
+    :param int num_moves: number of moves to play
+    :return ShogiEnv: env after num_moves random legal moves, with its whole move stack
+    """
+    rand = random.Random(seed)
+    while True:
+        env = ShogiEnv().reset()
+        for _ in range(num_moves):
+            moves = list(env.board.legal_moves)
+            if not moves or env.done:
+                break
+            env.push(rand.choice(moves))
+        else:
+            env.undo_stack = []
+            return env
+
+
+def random_lines(env, num, seed=0):
+    """
+    :return list(list(shogi.Move)): num random lines of DEPTH legal moves from env
+    """
+    rand = random.Random(seed)
+    env = env.copy()
+    lines = []
+    for _ in range(num):
+        line = []
+        for _ in range(DEPTH):
+            moves = list(env.board.legal_moves)
+            if not moves or env.done:
+                break
+            move = rand.choice(moves)
+            env.push(move)
+            line.append(move)
+        for _ in line:
+            env.pop()
+        lines.append(line)
+    return lines
+
+
+def copy_and_step(env, lines):
+    for line in lines:
+        search_env = env.copy()
+        for move in line:
+            search_env.step(move.usi())
+
+
+def push_and_pop(env, lines):
+    search_env = env.copy()
+    for line in lines:
+        for move in line:
+            search_env.push(move)
+        for _ in line:
+            search_env.pop()
+
+
+def main():
+    for num_moves in (10, 200):
+        env = random_game(num_moves)
+        lines = random_lines(env, NUM_SIMULATIONS)
+        results = []
+        for fn in (copy_and_step, push_and_pop):
+            start = timer()
+            fn(env, lines)
+            results.append((timer() - start) / len(lines))
+        print(f"move {num_moves:3}: copy + step {results[0] * 1e6:7.1f} us/simulation | "
+              f"push + pop {results[1] * 1e6:7.1f} us/simulation ({results[0] / results[1]:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Simulations per second of ShogiPlayer, applying the moves of the search with the trusted ShogiEnv.step_move
+and with the former round trip through usi notation and legality check. The network is replaced by
+a uniform policy and a zero value, so that only the cost of the search itself is measured.
+
+    python scripts/bench_search_speed.py
+"""
+import os
+import sys
+from timeit import default_timer as timer
+
+import numpy as np
+import shogi
+
+_PATH_ = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+if _PATH_ not in sys.path:
+    sys.path.append(_PATH_)
+
+from shogi_zero.agent.api_shogi import ShogiModelAPI  # noqa: E402
+from shogi_zero.agent.player_shogi import ShogiPlayer  # noqa: E402
+from shogi_zero.config import Config  # noqa: E402
+from shogi_zero.env.shogi_env import ShogiEnv  # noqa: E402
+
+NUM_MOVES = 6
+NUM_RUNS = 3
+
+
+class UniformNetwork:
+    def __init__(self, n_labels):
+        self.n_labels = n_labels
+
+    def predict_on_batch(self, data):
+        policy = np.full((len(data), self.n_labels), 1 / self.n_labels, dtype=np.float32)
+        return policy, np.zeros(len(data), dtype=np.float32)
+
+
+class UniformModel:
+    def __init__(self, config):
+        self.config = config
+        self.model = self.predict_model = UniformNetwork(config.n_labels)
+        self.digest = "uniform"
+        self.session = None
+
+
+def usi_step_move(step_move):
+    def step_move_from_usi(self, move, check_over=True):
+        move = shogi.Move.from_usi(move.usi())
+        assert move in self.board.legal_moves
+        step_move(self, move, check_over)
+    return step_move_from_usi
+
+
+def simulations_per_second(config, pipes):
+    player = ShogiPlayer(config, pipes=pipes)
+    env = ShogiEnv().reset()
+    start = timer()
+    for _ in range(NUM_MOVES):
+        env.step(player.action(env))
+    return NUM_MOVES * config.play.simulation_num_per_move / (timer() - start)
+
+
+def main():
+    config = Config("mini")
+    config.play.simulation_num_per_move = 200
+    config.play.reuse_tree = False
+    config.play.evaluation_cache_size = 0
+    config.play.opening_cache_slots = 0
+    api = ShogiModelAPI(UniformModel(config))
+    api.start()
+    pipes = [api.create_pipe() for _ in range(config.play.search_threads)]
+
+    step_move = ShogiEnv.step_move
+    for batch_search in (False, True):
+        config.play.batch_search = batch_search
+        before, after = 0, 0
+        for _ in range(NUM_RUNS):  # best of several runs, alternating, as thread scheduling makes them noisy
+            ShogiEnv.step_move = usi_step_move(step_move)
+            before = max(before, simulations_per_second(config, pipes))
+            ShogiEnv.step_move = step_move
+            after = max(after, simulations_per_second(config, pipes))
+        print(f"{'batched' if batch_search else 'threaded'} search: usi + step {before:7.1f} sims/s | "
+              f"step_move {after:7.1f} sims/s ({after / before:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
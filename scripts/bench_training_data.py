@@ -0,0 +1,91 @@
+"""
+Time the training waits for each batch of TrainingDataStream, with the batches built in the training process and
+with the batches built ahead by the loader processes, while a training step of STEP_SECONDS is simulated between
+two batches. The play data are random games written to a temporary directory.
+
+    python scripts/bench_training_data.py [config type]
+"""
+import os
+import shutil
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker
+from random import Random
+from time import sleep
+from timeit import default_timer as timer
+
+import numpy as np
+
+_PATH_ = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+if _PATH_ not in sys.path:
+    sys.path.append(_PATH_)
+
+from shogi_zero.config import Config  # noqa: E402
+from shogi_zero.env.shogi_env import ShogiEnv  # noqa: E402
+from shogi_zero.lib.data_helper import write_game_data_to_file  # noqa: E402
+from shogi_zero.lib.training_data import TrainingDataStream  # noqa: E402
+
+NUM_FILES = 4
+GAMES_PER_FILE = 10
+MAX_MOVES = 120
+NUM_BATCHES = 50
+STEP_SECONDS = 0.05
+
+
+def write_random_play_data(config, rand):
+    for index in range(NUM_FILES):
+        data = []
+        for _ in range(GAMES_PER_FILE):
+            env = ShogiEnv().reset()
+            moves = []
+            while not env.done and len(moves) < MAX_MOVES:
+                legal = list(env.board.legal_moves)
+                labels = np.array(rand.sample(range(config.n_labels), min(30, len(legal))), dtype=np.uint16)
+                moves.append([env.observation, (labels, np.full(len(labels), 1 / len(labels), dtype=np.float32))])
+                env.step(rand.choice(legal).usi())
+            z = rand.choice([-1, 1])
+            data += [move + [z if i % 2 == 0 else -z] for i, move in enumerate(moves)]
+        rc = config.resource
+        write_game_data_to_file(os.path.join(rc.play_data_dir, rc.play_data_filename_tmpl % f"{index:03}"), data)
+
+
+def waits(next_batch):
+    next_batch()  # warm up
+    times = []
+    for _ in range(NUM_BATCHES):
+        start = timer()
+        next_batch()
+        times.append(timer() - start)
+        sleep(STEP_SECONDS)
+    return np.array(times)
+
+
+def main():
+    config = Config(sys.argv[1] if len(sys.argv) > 1 else "mini")
+    tmp_dir = tempfile.mkdtemp()
+    rc = config.resource
+    rc.play_data_dir = os.path.join(tmp_dir, "play_data")
+    rc.training_shard_dir = os.path.join(tmp_dir, "training_shards")
+    os.makedirs(rc.play_data_dir)
+    os.makedirs(rc.training_shard_dir)
+    write_random_play_data(config, Random(0))
+
+    tc = config.trainer
+    resource_tracker.ensure_running()  # as in OptimizeWorker
+    with ProcessPoolExecutor(max_workers=tc.cleaning_processes) as executor:
+        stream = TrainingDataStream(config, executor)
+        try:
+            for name, next_batch in [("built in the training process", lambda: stream.take(tc.batch_size)),
+                                     (f"built by {tc.batch_loaders} loaders", lambda: next(stream))]:
+                times = waits(next_batch)
+                print(f"batch {tc.batch_size} {name:32}: wait median {np.median(times) * 1000:6.2f}ms "
+                      f"max {times.max() * 1000:6.2f}ms "
+                      f"({times.sum() / (times.sum() + STEP_SECONDS * NUM_BATCHES) * 100:.1f}% of the time)")
+        finally:
+            stream.close()
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Compares the latency and throughput of the requests to ShogiModelAPI through pipes (pickled observations and
+predictions) and through shared memory slots (the pipes only carry signals). The network is replaced by a
+uniform policy, so that only the transport is measured. A batch larger than the slots is measured too, as it
+goes through the pipe of a shared memory slot.
+
+    python scripts/bench_transport.py
+"""
+import multiprocessing as mp
+import os
+import sys
+from timeit import default_timer as timer
+
+import numpy as np
+
+_PATH_ = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+if _PATH_ not in sys.path:
+    sys.path.append(_PATH_)
+
+from shogi_zero.agent.api_shogi import ShogiModelAPI  # noqa: E402
+from shogi_zero.agent.player_shogi import canonical_labels  # noqa: E402
+from shogi_zero.config import Config  # noqa: E402
+from shogi_zero.env.shogi_env import ShogiEnv  # noqa: E402
+
+SFEN = "ln1g3nl/1r1sgkb2/p1pppp1pp/1p4p2/7P1/2P6/PP1PPPP1P/1BG2S1R1/LN2KG1NL b SPsp 17"
+BATCH_SIZE = 16
+NUM_CLIENTS = 8
+DURATION = 3.0
+
+
+class UniformNetwork:
+    def __init__(self, n_labels):
+        self.n_labels = n_labels
+
+    def predict_on_batch(self, data):
+        policy = np.full((len(data), self.n_labels), 1 / self.n_labels, dtype=np.float32)
+        return policy, np.zeros(len(data), dtype=np.float32)
+
+
+class UniformModel:
+    def __init__(self, config):
+        self.config = config
+        self.model = self.predict_model = UniformNetwork(config.n_labels)
+        self.digest = "uniform"
+        self.session = None
+
+
+def client(pipe, request, duration, results):
+    """
+    Sends the same request again and again for some time, and reports the number of requests
+    """
+    num = 0
+    start = timer()
+    while timer() - start < duration:
+        pipe.send(request)
+        pipe.recv()
+        num += 1
+    results.put(num)
+
+
+def requests_per_second(pipes, request, duration=DURATION):
+    results = mp.Queue()
+    clients = [mp.Process(target=client, args=(pipe, request, duration, results)) for pipe in pipes]
+    for c in clients:
+        c.start()
+    num = sum(results.get() for _ in clients)
+    for c in clients:
+        c.join()
+    return num / duration
+
+
+def main():
+    config = Config("mini")
+    config.play.prediction_max_wait = 0  # predict whatever is ready, as only the transport is measured
+    api = ShogiModelAPI(UniformModel(config))
+    api.start()
+
+    env = ShogiEnv().update(SFEN)
+    _, legal = env.legal_moves_and_labels()
+    planes, labels = env.canonical_input_planes(), canonical_labels(env, legal)
+    single = (planes, labels)
+    batch = (np.repeat(planes[np.newaxis], BATCH_SIZE, axis=0), [labels] * BATCH_SIZE)
+    oversized = (np.repeat(planes[np.newaxis], 2 * BATCH_SIZE, axis=0), [labels] * (2 * BATCH_SIZE))
+
+    transports = [("pipe", api.create_pipe), ("shared memory", lambda: api.create_shared_memory_pipe(BATCH_SIZE))]
+    all_pipes = []  # the server stops if a pipe is closed, so keep all of them open
+    for name, create in transports:
+        pipes = [create() for _ in range(NUM_CLIENTS)]
+        all_pipes += pipes
+        latency = 1 / requests_per_second(pipes[:1], single)
+        batch_latency = 1 / requests_per_second(pipes[:1], batch)
+        oversized_latency = 1 / requests_per_second(pipes[:1], oversized)
+        throughput = requests_per_second(pipes, single)
+        print(f"{name:13}: latency {latency * 1e6:7.1f} us, batch of {BATCH_SIZE} {batch_latency * 1e6:7.1f} us, "
+              f"of {2 * BATCH_SIZE} {oversized_latency * 1e6:7.1f} us | "
+              f"{NUM_CLIENTS} clients {throughput:8.0f} observations/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,21 @@ Defines the process which will listen on the pipe for
 an observation of the game state and return a prediction from the policy and
 value network.
 """
+import weakref
+from collections import Counter
+from logging import getLogger
 from multiprocessing import connection, Pipe
-from threading import Thread
+from threading import Event, Lock, Thread
+from time import time
 
 import numpy as np
 
+from shogi_zero.agent.shared_memory_pipe import SharedMemoryConnection, SharedMemorySlot
 from shogi_zero.config import Config
+from shogi_zero.lib.shared_memory_helper import has_shared_memory
+from shogi_zero.lib.tf_util import graph_session_scope
+
+logger = getLogger(__name__)
 
 
 class ShogiModelAPI:
@@ -19,6 +28,18 @@ class ShogiModelAPI:
     Attributes:
         :ivar ShogiModel agent_model: ShogiModel to use to make predictions.
         :ivar list(Connection): list of pipe connections to listen for states on and return predictions on.
+        :ivar dict(Connection,SharedMemorySlot) slots: shared memory slot of each of the pipes created by
+            create_shared_memory_pipe
+        :ivar list(SharedMemory) shared_memories: the blocks of all of the slots, removed when this api goes away
+        :ivar Connection wakeup_recv: wakes up the prediction worker when a pipe is created or weights are loaded
+        :ivar Connection wakeup_send: the other end of wakeup_recv
+        :ivar Lock wakeup_lock: held while sending on wakeup_send, from the threads of the players and servers
+        :ivar BatchStats batch_stats: statistics of the predicted batches
+        :ivar (Model,Model,str,Session,Event) standby: model loaded with new weights, the model to predict with,
+            the digest, the session of their graph, and the event set once the prediction worker swapped them in;
+            None when there is none
+        :ivar Thread prediction_worker: the thread which makes the predictions, None until start is called
+        :ivar boolean closed: whether close was called, which stops the prediction worker
     """
     # noinspection PyUnusedLocal
 
@@ -29,15 +50,41 @@ class ShogiModelAPI:
         """
         self.agent_model = agent_model
         self.pipes = []
+        self.slots = {}
+        self.shared_memories = []
+        weakref.finalize(self, _unlink_shared_memories, self.shared_memories)
+        self.wakeup_recv, self.wakeup_send = Pipe(duplex=False)
+        self.wakeup_lock = Lock()
+        self.batch_stats = BatchStats()
+        self.standby = None
+        self.prediction_worker = None
+        self.closed = False
 
     def start(self):
         """
         Starts a thread to listen on the pipe and make predictions
         :return:
         """
-        prediction_worker = Thread(target=self._predict_batch_worker, name="prediction_worker")
-        prediction_worker.daemon = True
-        prediction_worker.start()
+        self.prediction_worker = Thread(target=self._predict_batch_worker, name="prediction_worker")
+        self.prediction_worker.daemon = True
+        self.prediction_worker.start()
+
+    def close(self):
+        """
+        Stops the prediction worker, and closes the pipes and removes their shared memory slots. The requests in
+        flight are dropped, and the players must not use the pipes anymore.
+        """
+        self.closed = True
+        self._wake_up()
+        if self.prediction_worker is not None:
+            self.prediction_worker.join()
+        for pipe in self.pipes:
+            pipe.close()
+        self.pipes.clear()
+        for slot in self.slots.values():
+            slot.unlink()
+        self.slots.clear()
+        self.shared_memories.clear()
 
     def create_pipe(self):
         """
@@ -46,25 +93,286 @@ class ShogiModelAPI:
         :return Connection: the other end of this pipe.
         """
         me, you = Pipe()
-        self.pipes.append(me)
+        self.add_connection(me)
         return you
 
+    def create_shared_memory_pipe(self, max_batch_size):
+        """
+        Like create_pipe, but the observations and the predictions go through a slot of shared memory, and
+        the pipe only carries signals
+        :param int max_batch_size: max number of observations of a request that go through shared memory
+        :return SharedMemoryConnection: the end of this pipe and slot to give to a player
+        """
+        me, you = Pipe()
+        return SharedMemoryConnection(you, self.add_connection(me, max_batch_size), max_batch_size)
+
+    def add_connection(self, conn, max_batch_size=0):
+        """
+        Starts listening for requests on a connection, e.g. one end of a pipe or a connection of a client
+        of the inference server
+        :param Connection conn: connection to listen on
+        :param int max_batch_size: max number of observations of a request that go through shared memory,
+            0 to use the connection only
+        :return str: name of the shared memory block of the slot of the connection, None if there is none, e.g.
+            without multiprocessing.shared_memory
+        """
+        name = None
+        if max_batch_size and has_shared_memory():
+            slot = SharedMemorySlot(max_batch_size)
+            self.slots[conn] = slot
+            self.shared_memories.append(slot.shm)
+            name = slot.name
+        self.pipes.append(conn)
+        self._wake_up()
+        return name
+
+    def swap_model(self, model, predict_model, digest, session):
+        """
+        Makes the prediction worker use a model which is fully loaded, from its next batch on, and waits until it
+        does. The batches in flight keep being predicted by the previous model meanwhile. When there is no
+        prediction worker running (it was not started, it stopped or it died), the model is swapped in right away.
+
+        :param Model model: the model with the new weights
+        :param Model predict_model: the model to predict with, model or its predict-only copy
+        :param str digest: digest of the new weights, sent back with the predictions of the new model
+        :param Session session: session of the graph of the models, None for the session of Keras
+        """
+        swapped = Event()
+        self.standby = (model, predict_model, digest, session, swapped)
+        self._wake_up()
+        while not swapped.wait(timeout=1):
+            if self.prediction_worker is None or not self.prediction_worker.is_alive():
+                logger.warning("no prediction worker is running, swapping in the new weights now")
+                self._swap_standby()
+
+    def _swap_standby(self):
+        """
+        Swaps in the standby model if there is one, from the prediction worker between two batches
+        """
+        standby, self.standby = self.standby, None
+        if standby is not None:
+            model, predict_model, digest, session, swapped = standby
+            agent_model = self.agent_model
+            agent_model.model, agent_model.predict_model, agent_model.digest, agent_model.session = \
+                model, predict_model, digest, session
+            swapped.set()
+
     def _predict_batch_worker(self):
         """
-        Thread worker which listens on each pipe in self.pipes for an observation, and then outputs
-        the predictions for the policy and value networks when the observations come in. Repeats.
+        Thread worker which listens on each pipe in self.pipes for an observation (or a batch of observations)
+        along with the canonical label indices of its legal moves, and then outputs the predictions for the value
+        network and the normalized priors of those legal moves when the observations come in, along with the
+        digest of the model weights that made them. Repeats until close is called.
+
+        The observations are batched as configured by PlayConfig.prediction_batch_size and
+        PlayConfig.prediction_max_wait. New weights are swapped in between two batches, see swap_model.
         """
+        play_config = self.agent_model.config.play
         while True:
-            ready = connection.wait(self.pipes, timeout=0.001)
-            if not ready:
-                continue
-            data, result_pipes = [], []
-            for pipe in ready:
-                while pipe.poll():
-                    data.append(pipe.recv())
-                    result_pipes.append(pipe)
-
-            data = np.asarray(data, dtype=np.float32)
-            policy_ary, value_ary = self.agent_model.model.predict_on_batch(data)
-            for pipe, p, v in zip(result_pipes, policy_ary, value_ary):
-                pipe.send((p, float(v)))
+            requests, queue_wait = self._collect_batch(play_config.prediction_batch_size,
+                                                       play_config.prediction_max_wait)
+            if requests is None:
+                return
+            self._swap_standby()
+            data = np.concatenate([state_planes for _, state_planes, _, _, _ in requests])
+            data = data.astype(np.float32, copy=False)
+            legal_labels = [labels for _, _, request_labels, _, _ in requests for labels in request_labels]
+
+            start = time()
+            with graph_session_scope(self.agent_model.session):
+                policy_ary, value_ary = self.agent_model.predict_model.predict_on_batch(data)
+            model_time = time() - start
+            self.batch_stats.add(len(data), queue_wait, model_time)
+
+            priors = gather_legal_priors(policy_ary, legal_labels)
+            value_ary = value_ary.reshape(-1)
+            digest = self.agent_model.digest
+            i = 0
+            for pipe, state_planes, _, single, in_slot in requests:
+                n = len(state_planes)
+                try:
+                    if in_slot:
+                        self.slots[pipe].write_reply(priors[i:i + n], value_ary[i:i + n])
+                        pipe.send(digest)
+                    elif single:
+                        pipe.send((priors[i], float(value_ary[i]), digest))
+                    else:
+                        pipe.send((priors[i:i + n], value_ary[i:i + n], digest))
+                except OSError:  # the player end went away meanwhile, e.g. its process was killed
+                    self._drop(pipe)
+                i += n
+
+    def _collect_batch(self, max_batch_size, max_wait):
+        """
+        Blocks until a request comes in, then keeps collecting requests until there are max_batch_size
+        observations, max_wait seconds passed since the first request, or every pipe is waiting for a reply.
+
+        :param int max_batch_size: number of observations which triggers a prediction
+        :param float max_wait: max seconds the first request waits for the batch to fill
+        :return (list((Connection,np.ndarray,list(np.ndarray),boolean,boolean)),float): each request, see _receive,
+            then the seconds the first request waited. None and 0 once close is called.
+        """
+        requests = []
+        num_observations = 0
+        first_time = None
+        while True:
+            timeout = None if first_time is None else first_time + max_wait - time()
+            if timeout is not None and timeout <= 0:
+                break
+            pending = set(pipe for pipe, _, _, _, _ in requests)
+            waiting = [pipe for pipe in self.pipes if pipe not in pending]
+            if requests and not waiting:
+                break
+            for pipe in connection.wait(waiting + [self.wakeup_recv], timeout):
+                if pipe is self.wakeup_recv:  # a pipe was created, weights were loaded or the api was closed
+                    pipe.recv()
+                    if self.closed:
+                        return None, 0
+                    self._swap_standby()
+                    continue
+                request = self._receive(pipe)
+                if request is None:
+                    continue
+                requests.append(request)
+                num_observations += len(request[1])
+                if first_time is None:
+                    first_time = time()
+            if num_observations >= max_batch_size:
+                break
+        return requests, time() - first_time
+
+    def _receive(self, pipe):
+        """
+        :param Connection pipe: pipe with a request to read
+        :return (Connection,np.ndarray,list(np.ndarray),boolean,boolean): the pipe, the observations, the legal
+            labels of each of them, whether it is a single observation and whether it came through the shared
+            memory slot of the pipe, in which case the reply goes there too. None if the player end of the pipe
+            was closed.
+        """
+        try:
+            request = pipe.recv()
+        except (EOFError, OSError):  # the player end was closed or its process was killed
+            self._drop(pipe)
+            return None
+        # a request which does not fit in the slot of the pipe comes through the pipe itself
+        in_slot = isinstance(request, int)
+        if in_slot:  # the request is in shared memory, this is its number of observations
+            state_planes, legal_labels = self.slots[pipe].read_request(request)
+        else:
+            state_planes, legal_labels = request
+        # a request is either one observation or a batch of them
+        if state_planes.ndim == 4:
+            return pipe, state_planes, legal_labels, False, in_slot
+        return pipe, state_planes[np.newaxis], [legal_labels], True, in_slot
+
+    def _drop(self, pipe):
+        """
+        Stops listening to a pipe whose player end went away, and removes its slot
+
+        :param Connection pipe: the pipe
+        """
+        self.pipes.remove(pipe)
+        pipe.close()
+        slot = self.slots.pop(pipe, None)
+        if slot is not None:
+            self.shared_memories.remove(slot.shm)
+            slot.unlink()
+
+    def _wake_up(self):
+        """
+        Wakes up the prediction worker if it is waiting for requests
+        """
+        with self.wakeup_lock:
+            self.wakeup_send.send(None)
+
+
+class BatchStats:
+    """
+    Statistics of the batches predicted by ShogiModelAPI since the last call to summary.
+
+    Attributes:
+        :ivar Counter sizes: number of batches of each size
+        :ivar float queue_wait: total seconds the first request of each batch waited for the batch to fill
+        :ivar float model_time: total seconds spent in the model
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.sizes = Counter()
+        self.queue_wait = 0
+        self.model_time = 0
+
+    def add(self, size, queue_wait, model_time):
+        with self.lock:
+            self.sizes[size] += 1
+            self.queue_wait += queue_wait
+            self.model_time += model_time
+
+    def summary(self):
+        """
+        Gets the statistics and starts new ones
+
+        :return dict: number of batches and of observations, mean batch size, histogram of the batch sizes by
+            power of 2 (the bucket 4 counts the batches of 4 to 7 observations), and mean queue wait and model
+            time per batch in seconds
+        """
+        with self.lock:
+            sizes, queue_wait, model_time = self.sizes, self.queue_wait, self.model_time
+            self.sizes = Counter()
+            self.queue_wait = 0
+            self.model_time = 0
+        num_batches = sum(sizes.values())
+        num_observations = sum(size * num for size, num in sizes.items())
+        histogram = Counter()
+        for size, num in sizes.items():
+            histogram[1 << (size.bit_length() - 1)] += num
+        return {"batches": num_batches, "observations": num_observations,
+                "mean_size": num_observations / num_batches if num_batches else 0,
+                "histogram": dict(sorted(histogram.items())),
+                "queue_wait": queue_wait / num_batches if num_batches else 0,
+                "model_time": model_time / num_batches if num_batches else 0}
+
+
+def gather_legal_priors(policy_ary, legal_labels):
+    """
+    Picks the priors of the legal moves out of the policies predicted for a batch, and normalizes them
+
+    :param np.ndarray policy_ary: policies predicted for a batch of observations
+    :param list(np.ndarray) legal_labels: label indices of the legal moves of each of the observations
+    :return list(np.ndarray): the priors of the legal moves of each of the observations, in the same order
+    """
+    lengths = [len(labels) for labels in legal_labels]
+    rows = np.repeat(np.arange(len(legal_labels)), lengths)
+    priors = policy_ary[rows, np.concatenate(legal_labels).astype(np.intp)]
+    totals = np.bincount(rows, weights=priors, minlength=len(legal_labels))
+    priors = (priors / (totals[rows] + 1e-8)).astype(np.float32)
+    return np.split(priors, np.cumsum(lengths)[:-1])
+
+
+def _unlink_shared_memories(shared_memories):
+    for shm in shared_memories:
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def connect_to_server(rc, play_config):
+    """
+    Opens the connections of one player to the inference server of this machine (the "server" command), to use
+    instead of the pipes of a model of this process. Like ShogiModel.get_pipes, the requests go through shared
+    memory with PlayConfig.shared_memory_transport when both ends have multiprocessing.shared_memory.
+
+    :param ResourceConfig rc: resources, to find the address of the server
+    :param PlayConfig play_config: how the player searches, for the number of connections and the size of requests
+    :return list(Connection): search_threads connections, with the same interface as the pipes of ShogiModelAPI
+    """
+    max_batch_size = play_config.search_threads if play_config.shared_memory_transport and has_shared_memory() \
+        else 0
+    pipes = []
+    for _ in range(play_config.search_threads):
+        conn = connection.Client(rc.inference_server_address, family="AF_UNIX", authkey=rc.inference_server_authkey)
+        conn.send(max_batch_size)
+        name = conn.recv()
+        pipes.append(conn if name is None else SharedMemoryConnection(conn, name, max_batch_size, remote=True))
+    return pipes
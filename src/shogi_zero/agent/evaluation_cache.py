@@ -0,0 +1,258 @@
+"""
+Caches of network evaluations, so that players do not ask the model again about positions it already evaluated.
+"""
+import os
+import zlib
+from collections import OrderedDict
+from glob import glob
+from logging import getLogger
+from threading import Lock
+
+import numpy as np
+
+logger = getLogger(__name__)
+
+_evaluation_cache = None
+_opening_caches = {}
+
+
+def get_evaluation_cache(size):
+    """
+    Gets the evaluation cache of this process, creating it on first use
+
+    :param int size: max number of evaluations to keep. 0 disables the cache.
+    :return EvaluationCache: the cache shared by all of the players of this process, None if disabled
+    """
+    global _evaluation_cache
+    if not size:
+        return None
+    if _evaluation_cache is None:
+        _evaluation_cache = EvaluationCache(size)
+    return _evaluation_cache
+
+
+class EvaluationCache:
+    """
+    Bounded LRU cache of network evaluations, keyed by model digest plus position. An evaluation is the priors of
+    the legal moves of the position, in the order of board.legal_moves, and its value.
+
+    Attributes:
+        :ivar int size: max number of evaluations to keep
+        :ivar OrderedDict entries: (digest, position key) -> (priors, value), least recently used first
+        :ivar int nbytes: memory used by the cached priors
+        :ivar int hits: number of lookups that found an evaluation
+        :ivar int misses: number of lookups that did not
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def get(self, digest, key):
+        """
+        :param str digest: digest of the model weights
+        :param key: key of the position
+        :return (np.ndarray, float): the cached priors and value, None if not cached
+        """
+        with self.lock:
+            entry = self.entries.get((digest, key))
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end((digest, key))
+            self.hits += 1
+            return entry
+
+    def put(self, digest, key, priors, value):
+        """
+        :param str digest: digest of the model weights
+        :param key: key of the position
+        :param np.ndarray priors: priors predicted for the legal moves of the position
+        :param float value: value predicted for the position
+        """
+        with self.lock:
+            if (digest, key) in self.entries:
+                return
+            self.entries[(digest, key)] = (priors, value)
+            self.nbytes += priors.nbytes
+            while len(self.entries) > self.size:
+                _, (old_priors, _) = self.entries.popitem(last=False)
+                self.nbytes -= old_priors.nbytes
+
+    def invalidate(self, digest):
+        """
+        Drops all of the evaluations made by some model weights
+
+        :param str digest: digest of the model weights which are not used anymore
+        """
+        with self.lock:
+            for entry_key in [k for k in self.entries if k[0] == digest]:
+                priors, _ = self.entries.pop(entry_key)
+                self.nbytes -= priors.nbytes
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+    def stats(self):
+        """
+        :return dict(str,float): number of entries, memory, hits, misses and hit rate of the cache
+        """
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.nbytes, "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hit_rate}
+
+
+def get_opening_cache(rc, digest, num_slots):
+    """
+    Gets the opening cache of some model weights, opening or creating its file on first use. The caches of the
+    other weights this process opened are closed then, as their files are removed once the weights are replaced.
+
+    :param ResourceConfig rc: resources, to find the cache directory
+    :param str digest: digest of the model weights
+    :param int num_slots: number of positions the cache file can hold. 0 disables the cache.
+    :return OpeningCache: the cache of this process for these weights, None if disabled
+    """
+    if not num_slots or digest is None:
+        return None
+    if digest not in _opening_caches:
+        for stale in list(_opening_caches):
+            _opening_caches.pop(stale).close()
+        path = os.path.join(rc.evaluation_cache_dir, rc.evaluation_cache_filename_tmpl % digest)
+        _opening_caches[digest] = OpeningCache(path, num_slots)
+    return _opening_caches[digest]
+
+
+def remove_stale_opening_caches(rc, digest):
+    """
+    Deletes the opening cache files of all of the model weights but one. Processes which still have one of them
+    open keep using it until they see the new weights.
+
+    :param ResourceConfig rc: resources, to find the cache directory
+    :param str digest: digest of the weights whose cache is kept
+    """
+    keep = os.path.join(rc.evaluation_cache_dir, rc.evaluation_cache_filename_tmpl % digest)
+    for path in glob(os.path.join(rc.evaluation_cache_dir, rc.evaluation_cache_filename_tmpl % "*")):
+        if path != keep:
+            logger.debug(f"remove stale opening cache {path}")
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class OpeningCache:
+    """
+    Persistent evaluation cache for shallow positions, stored as an open-addressing hash table in a memory-mapped
+    file, so that all of the workers of a machine share it. Each file holds the evaluations of one model,
+    as the legal move labels with their priors plus the value.
+
+    Entries are never removed, a full probe sequence overwrites its first slot. Writers clear the key of the slot
+    first and set it last, and readers check a crc of the entry, so a reader never uses an entry that is being
+    written by another process.
+
+    Attributes:
+        :ivar str path: file holding the table
+        :ivar np.memmap table: the slots, None once the cache is closed
+        :ivar int hits: number of lookups of this process that found an evaluation
+        :ivar int misses: number of lookups of this process that did not
+    """
+    max_moves = 128
+    max_probes = 8
+    dtype = np.dtype([("key", "<u8"), ("info", "<u4"), ("crc", "<u4"), ("value", "<f4"), ("num_moves", "<u2"),
+                      ("legal", "<u2", max_moves), ("prior", "<f4", max_moves)])
+
+    def __init__(self, path, num_slots):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < num_slots * self.dtype.itemsize:
+                os.ftruncate(fd, num_slots * self.dtype.itemsize)  # zero filled, i.e. empty slots
+        finally:
+            os.close(fd)
+        self.table = np.memmap(path, dtype=self.dtype, mode="r+", shape=(num_slots,))
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, info):
+        """
+        :param int key: 64-bit key of the position
+        :param int info: 32-bit extra check of the position
+        :return (np.ndarray, np.ndarray, float): label indices of the legal moves, their priors and the value,
+            None if not cached
+        """
+        table = self.table  # the same one all along, even if the cache is closed meanwhile
+        if table is None:
+            return None
+        key = np.uint64(key or 1)
+        for slot in self._probe(key, len(table)):
+            if table["key"][slot] != key:
+                continue
+            entry = table[slot].copy()
+            if entry["key"] != key or entry["info"] != info or entry["crc"] != self._crc(entry):
+                break
+            self.hits += 1
+            n = entry["num_moves"]
+            return entry["legal"][:n].astype(np.intp), entry["prior"][:n], float(entry["value"])
+        self.misses += 1
+        return None
+
+    def put(self, key, info, legal, prior, value):
+        """
+        :param int key: 64-bit key of the position
+        :param int info: 32-bit extra check of the position
+        :param np.ndarray legal: label indices of the legal moves
+        :param np.ndarray prior: prior of each of the legal moves
+        :param float value: value of the position
+        """
+        table = self.table
+        if len(legal) > self.max_moves or table is None:
+            return
+        key = np.uint64(key or 1)
+        probes = self._probe(key, len(table))
+        slot = probes[0]
+        for s in probes:
+            if table["key"][s] in (0, key):
+                slot = s
+                break
+        entry = np.zeros((), dtype=self.dtype)
+        entry["info"] = info
+        entry["value"] = value
+        entry["num_moves"] = len(legal)
+        entry["legal"][:len(legal)] = legal
+        entry["prior"][:len(legal)] = prior
+        entry["crc"] = self._crc(entry)
+        table["key"][slot] = 0
+        table[slot] = entry
+        table["key"][slot] = key
+
+    def close(self):
+        """
+        Drops the mapping of the file, which is unmapped once the lookups in flight are done. The lookups of the
+        players which still hold this cache miss from then on.
+        """
+        self.table = None
+
+    def _probe(self, key, num_slots):
+        start = int(key) % num_slots
+        return [(start + i) % num_slots for i in range(self.max_probes)]
+
+    @staticmethod
+    def _crc(entry):
+        n = int(entry["num_moves"])
+        crc = zlib.crc32(np.array([entry["info"], n], dtype="<u4").tobytes())
+        crc = zlib.crc32(np.asarray(entry["value"], dtype="<f4").tobytes(), crc)
+        crc = zlib.crc32(entry["legal"][:n].tobytes(), crc)
+        return zlib.crc32(entry["prior"][:n].tobytes(), crc)
+
+    def stats(self):
+        """
+        :return dict(str,float): number of hits and misses of this process, and hit rate
+        """
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0}
@@ -8,6 +8,8 @@ import json
 import os
 from logging import getLogger
 
+import numpy as np
+
 from keras.engine.topology import Input
 from keras.engine.training import Model
 from keras.layers.convolutional import Conv2D
@@ -17,7 +19,10 @@ from keras.layers.normalization import BatchNormalization
 from keras.regularizers import l2
 
 from shogi_zero.agent.api_shogi import ShogiModelAPI
+from shogi_zero.agent.onnx_model import OnnxNetwork, onnx_model_path
 from shogi_zero.config import Config
+from shogi_zero.lib.shared_memory_helper import has_shared_memory
+from shogi_zero.lib.tf_util import graph_session_scope, new_graph_session
 
 # noinspection PyPep8Naming
 
@@ -32,14 +37,21 @@ class ShogiModel:
     Attributes:
         :ivar Config config: configuration to use
         :ivar Model model: the Keras model to use for predictions
+        :ivar Model predict_model: the model the api predicts with, model, its predict-only copy or its exported
+            OnnxNetwork
         :ivar digest: basically just a hash of the file containing the weights being used by this model
+        :ivar Session session: the session of the graph of model, None for the graph and session of Keras. The api
+            predicts in graphs of their own, which other threads never build in: once get_pipes is called, use the
+            models under graph_session_scope(session).
         :ivar ShogiModelAPI api: the api to use to listen for and then return this models predictions (on a pipe).
     """
 
     def __init__(self, config: Config):
         self.config = config
         self.model = None  # type: Model
+        self.predict_model = None  # type: Model
         self.digest = None
+        self.session = None
         self.api = None
 
     def get_pipes(self, num=1):
@@ -47,71 +59,183 @@ class ShogiModel:
         Creates a list of pipes on which observations of the game state will be listened for. Whenever
         an observation comes in, returns policy and value network predictions on that pipe.
 
+        With PlayConfig.shared_memory_transport, the observations and predictions go through shared memory
+        and the pipes only carry signals, unless multiprocessing.shared_memory is missing (Python < 3.8).
+
         :param int num: number of pipes to create
         :return str(Connection): a list of all connections to the pipes that were created
         """
         if self.api is None:
+            if self.session is None:
+                weights, session = self.model.get_weights(), new_graph_session()
+                with graph_session_scope(session):
+                    self.model = Model.from_config(self.model.get_config())
+                    self.model.set_weights(weights)
+                    self.model._make_predict_function()
+                self.session = session
+            with graph_session_scope(self.session):
+                self.predict_model = self._predict_model_of(self.model, self.digest)
             self.api = ShogiModelAPI(self)
             self.api.start()
+        if self.config.play.shared_memory_transport and has_shared_memory():
+            return [self.api.create_shared_memory_pipe(self.config.play.search_threads) for _ in range(num)]
         return [self.api.create_pipe() for _ in range(num)]
 
+    def close_pipes(self):
+        """
+        Stops the api started by get_pipes, if any, and frees its pipes and their shared memory. The pipes
+        must not be used anymore, get_pipes starts a new api.
+        """
+        if self.api is not None:
+            self.api.close()
+            self.api = None
+
     def build(self):
         """
         Builds the full Keras model and stores it in self.model.
         """
+        self.model = self._build_network()
+
+    def predict_only_model(self, model):
+        """
+        Exports a predict-only copy of a model built by build: each batch normalization is folded into the
+        convolution before it, as a scale of the kernel and a bias, and the regularizers are dropped. The
+        predictions are the same up to float rounding, for the cost of the convolutions alone.
+
+        :param Model model: the model, with its trained weights
+        :return Model: the predict-only model
+        """
+        folded_weights = {}
+        for conv_name, batchnorm_name in self._conv_batchnorm_names():
+            batchnorm = model.get_layer(batchnorm_name)
+            gamma, beta, moving_mean, moving_variance = batchnorm.get_weights()
+            scale = gamma / np.sqrt(moving_variance + batchnorm.epsilon)
+            # the kernel is (rows, cols, input channels, output channels) for both data formats
+            kernel = model.get_layer(conv_name).get_weights()[0]
+            folded_weights[conv_name] = [kernel * scale, beta - moving_mean * scale]
+
+        predict_model = self._build_network(inference=True)
+        for layer in predict_model.layers:
+            if layer.weights:
+                weights = folded_weights.get(layer.name)
+                layer.set_weights(weights if weights is not None else model.get_layer(layer.name).get_weights())
+        predict_model._make_predict_function()
+        return predict_model
+
+    def _predict_model_of(self, model, digest):
+        """
+        :param Model model: the model, with its trained weights
+        :param str digest: digest of the weights, to find the models exported from them
+        :return Model: the model the api predicts with, see PlayConfig.inference_backend and
+            PlayConfig.fold_batchnorm
+        """
+        backend = self.config.play.inference_backend
+        if backend != "keras" and digest is not None:
+            path = onnx_model_path(self.config.resource, digest, int8=backend == "onnx_int8")
+            if os.path.exists(path):
+                logger.debug(f"predicting with {path}")
+                return OnnxNetwork(path)
+            logger.warning(f"{path} does not exist, run the export command; predicting with Keras meanwhile")
+        if not self.config.play.fold_batchnorm:
+            return model
+        try:
+            return self.predict_only_model(model)
+        except ValueError as e:  # the model was built with another ModelConfig
+            logger.warning(f"cannot fold the batch normalizations of the model, predicting with it as is: {e}")
+            return model
+
+    def _build_network(self, inference=False):
+        """
+        :param boolean inference: whether to build the predict-only network, without batch normalizations (their
+            convolutions have biases instead) and without regularizers
+        :return Model: the network, with initial weights
+        """
         mc = self.config.model
+        reg = None if inference else l2(mc.l2_reg)
         in_x = x = Input((44, 9, 9))
 
         # (batch, channels, height, width)
-        x = Conv2D(filters=mc.cnn_filter_num, kernel_size=mc.cnn_first_filter_size, padding="same",
-                   data_format="channels_first", use_bias=False, kernel_regularizer=l2(mc.l2_reg),
-                   name="input_conv-" + str(mc.cnn_first_filter_size) + "-" + str(mc.cnn_filter_num))(x)
-        x = BatchNormalization(axis=1, name="input_batchnorm")(x)
+        x = self._conv_batchnorm(x, mc.cnn_filter_num, mc.cnn_first_filter_size, "same",
+                                 "input_conv-" + str(mc.cnn_first_filter_size) + "-" + str(mc.cnn_filter_num),
+                                 "input_batchnorm", inference)
         x = Activation("relu", name="input_relu")(x)
 
         for i in range(mc.res_layer_num):
-            x = self._build_residual_block(x, i + 1)
+            x = self._build_residual_block(x, i + 1, inference)
 
         res_out = x
 
         # for policy output
-        x = Conv2D(filters=2, kernel_size=1, data_format="channels_first", use_bias=False, kernel_regularizer=l2(mc.l2_reg),
-                   name="policy_conv-1-2")(res_out)
-        x = BatchNormalization(axis=1, name="policy_batchnorm")(x)
+        x = self._conv_batchnorm(res_out, 2, 1, "valid", "policy_conv-1-2", "policy_batchnorm", inference)
         x = Activation("relu", name="policy_relu")(x)
         x = Flatten(name="policy_flatten")(x)
         # no output for 'pass'
-        policy_out = Dense(self.config.n_labels, kernel_regularizer=l2(
-            mc.l2_reg), activation="softmax", name="policy_out")(x)
+        policy_out = Dense(self.config.n_labels, kernel_regularizer=reg, activation="softmax", name="policy_out")(x)
 
         # for value output
-        x = Conv2D(filters=4, kernel_size=1, data_format="channels_first", use_bias=False, kernel_regularizer=l2(mc.l2_reg),
-                   name="value_conv-1-4")(res_out)
-        x = BatchNormalization(axis=1, name="value_batchnorm")(x)
+        x = self._conv_batchnorm(res_out, 4, 1, "valid", "value_conv-1-4", "value_batchnorm", inference)
         x = Activation("relu", name="value_relu")(x)
         x = Flatten(name="value_flatten")(x)
-        x = Dense(mc.value_fc_size, kernel_regularizer=l2(mc.l2_reg), activation="relu", name="value_dense")(x)
-        value_out = Dense(1, kernel_regularizer=l2(mc.l2_reg), activation="sigmoid", name="value_out")(x)
+        x = Dense(mc.value_fc_size, kernel_regularizer=reg, activation="relu", name="value_dense")(x)
+        value_out = Dense(1, kernel_regularizer=reg, activation="sigmoid", name="value_out")(x)
 
-        self.model = Model(in_x, [policy_out, value_out], name="shogi_model")
+        return Model(in_x, [policy_out, value_out], name="shogi_model")
 
-    def _build_residual_block(self, x, index):
+    def _build_residual_block(self, x, index, inference):
         mc = self.config.model
         in_x = x
         res_name = "res" + str(index)
-        x = Conv2D(filters=mc.cnn_filter_num, kernel_size=mc.cnn_filter_size, padding="same",
-                   data_format="channels_first", use_bias=False, kernel_regularizer=l2(mc.l2_reg),
-                   name=res_name + "_conv1-" + str(mc.cnn_filter_size) + "-" + str(mc.cnn_filter_num))(x)
-        x = BatchNormalization(axis=1, name=res_name + "_batchnorm1")(x)
+        x = self._conv_batchnorm(x, mc.cnn_filter_num, mc.cnn_filter_size, "same",
+                                 res_name + "_conv1-" + str(mc.cnn_filter_size) + "-" + str(mc.cnn_filter_num),
+                                 res_name + "_batchnorm1", inference)
         x = Activation("relu", name=res_name + "_relu1")(x)
-        x = Conv2D(filters=mc.cnn_filter_num, kernel_size=mc.cnn_filter_size, padding="same",
-                   data_format="channels_first", use_bias=False, kernel_regularizer=l2(mc.l2_reg),
-                   name=res_name + "_conv2-" + str(mc.cnn_filter_size) + "-" + str(mc.cnn_filter_num))(x)
-        x = BatchNormalization(axis=1, name="res" + str(index) + "_batchnorm2")(x)
+        x = self._conv_batchnorm(x, mc.cnn_filter_num, mc.cnn_filter_size, "same",
+                                 res_name + "_conv2-" + str(mc.cnn_filter_size) + "-" + str(mc.cnn_filter_num),
+                                 res_name + "_batchnorm2", inference)
         x = Add(name=res_name + "_add")([in_x, x])
         x = Activation("relu", name=res_name + "_relu2")(x)
         return x
 
+    def _conv_batchnorm(self, x, filters, kernel_size, padding, conv_name, batchnorm_name, inference):
+        """
+        A convolution followed by a batch normalization, or by nothing in the predict-only network, where the
+        convolution takes over the batch normalization with a bias
+        """
+        x = Conv2D(filters=filters, kernel_size=kernel_size, padding=padding, data_format="channels_first",
+                   use_bias=inference, kernel_regularizer=None if inference else l2(self.config.model.l2_reg),
+                   name=conv_name)(x)
+        if not inference:
+            x = BatchNormalization(axis=1, name=batchnorm_name)(x)
+        return x
+
+    def _conv_batchnorm_names(self):
+        """
+        :return list((str,str)): the names of the convolution and of the batch normalization of each
+            _conv_batchnorm of the network of _build_network
+        """
+        mc = self.config.model
+        names = [("input_conv-" + str(mc.cnn_first_filter_size) + "-" + str(mc.cnn_filter_num), "input_batchnorm")]
+        for index in range(1, mc.res_layer_num + 1):
+            res_name = "res" + str(index)
+            for i in ("1", "2"):
+                names.append((res_name + "_conv" + i + "-" + str(mc.cnn_filter_size) + "-" + str(mc.cnn_filter_num),
+                              res_name + "_batchnorm" + i))
+        names += [("policy_conv-1-2", "policy_batchnorm"), ("value_conv-1-4", "value_batchnorm")]
+        return names
+
+    @staticmethod
+    def _load_network(config_path, weight_path):
+        """
+        :param str config_path: path to the file containing the entire configuration
+        :param str weight_path: path to the file containing the model weights
+        :return Model: the network, built in the default graph, ready to predict
+        """
+        with open(config_path, "rt") as f:
+            model = Model.from_config(json.load(f))
+        model.load_weights(weight_path)
+        model._make_predict_function()
+        return model
+
     @staticmethod
     def fetch_digest(weight_path):
         if os.path.exists(weight_path):
@@ -122,6 +246,8 @@ class ShogiModel:
 
     def load(self, config_path, weight_path):
         """
+        Loads the model. When its api serves predictions, the weights are loaded into a standby model, which the
+        api swaps in between two batches.
 
         :param str config_path: path to the file containing the entire configuration
         :param str weight_path: path to the file containing the model weights
@@ -143,11 +269,18 @@ class ShogiModel:
                 pass
         if os.path.exists(config_path) and os.path.exists(weight_path):
             logger.debug(f"loading model from {config_path}")
-            with open(config_path, "rt") as f:
-                self.model = Model.from_config(json.load(f))
-            self.model.load_weights(weight_path)
-            self.model._make_predict_function()
-            self.digest = self.fetch_digest(weight_path)
+            digest = self.fetch_digest(weight_path)
+            previous = self.session
+            if self.api is None:
+                self.model, self.digest, self.session = self._load_network(config_path, weight_path), digest, None
+            else:  # the api keeps predicting with the previous weights until the new ones are fully loaded
+                session = new_graph_session()
+                with graph_session_scope(session):
+                    model = self._load_network(config_path, weight_path)
+                    predict_model = self._predict_model_of(model, digest)
+                self.api.swap_model(model, predict_model, digest, session)
+            if previous is not None:
+                previous.close()
             logger.debug(f"loaded model digest = {self.digest}")
             return True
         else:
@@ -161,7 +294,7 @@ class ShogiModel:
         :param str weight_path: path to save the model weights to
         """
         logger.debug(f"save model to {config_path}")
-        with open(config_path, "wt") as f:
+        with open(config_path, "wt") as f, graph_session_scope(self.session):
             json.dump(self.model.get_config(), f)
             self.model.save_weights(weight_path)
         self.digest = self.fetch_digest(weight_path)
@@ -0,0 +1,115 @@
+"""
+Portable inference models: the predict-only network exported to ONNX, optionally quantized to int8, and run by
+onnxruntime instead of Keras. keras2onnx, onnx and onnxruntime are only needed by these functions.
+"""
+import os
+from glob import glob
+from logging import getLogger
+
+import numpy as np
+
+logger = getLogger(__name__)
+
+
+def onnx_model_path(rc, digest, int8=False):
+    """
+    :param ResourceConfig rc: resources, to find the model directory
+    :param str digest: digest of the Keras weights the model was exported from
+    :param boolean int8: whether to get the quantized model
+    :return str: path of the exported model
+    """
+    return os.path.join(rc.model_dir, rc.model_best_onnx_filename_tmpl % (digest + ("_int8" if int8 else "")))
+
+
+def remove_stale_onnx_models(rc, digest):
+    """
+    Removes the exported models of other weights than the ones with this digest
+    """
+    for path in glob(os.path.join(rc.model_dir, rc.model_best_onnx_filename_tmpl % "*")):
+        if path not in (onnx_model_path(rc, digest), onnx_model_path(rc, digest, int8=True)):
+            os.remove(path)
+
+
+def export_onnx(model, path):
+    """
+    :param Model model: the Keras model to export, usually the predict-only one of ShogiModel.predict_only_model
+    :param str path: path to write the ONNX model to
+    """
+    import keras2onnx
+    from onnx import version_converter
+    onnx_model = keras2onnx.convert_keras(model, model.name)
+    # keras2onnx writes the lowest opset the ops need, quantize_onnx needs 13 for the per-channel QDQ format
+    opset = max(opset.version for opset in onnx_model.opset_import if opset.domain in ("", "ai.onnx"))
+    if opset < 13:
+        onnx_model = version_converter.convert_version(onnx_model, 13)
+    keras2onnx.save_model(onnx_model, path)
+
+
+def quantize_onnx(float_path, int8_path, calibration_states, batch_size):
+    """
+    Post-training static quantization: the weights are quantized per channel to int8, and the activations to
+    uint8 with the ranges they take on the calibration positions
+
+    :param str float_path: path of the ONNX model to quantize
+    :param str int8_path: path to write the quantized model to
+    :param np.ndarray calibration_states: input planes of the calibration positions
+    :param int batch_size: positions per calibration batch
+    """
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+
+    class CalibrationData(CalibrationDataReader):
+        def __init__(self):
+            self.input_name = OnnxNetwork(float_path).input_name
+            self.batches = iter(np.array_split(calibration_states, max(1, len(calibration_states) // batch_size)))
+
+        def get_next(self):
+            batch = next(self.batches, None)
+            return None if batch is None else {self.input_name: batch}
+
+    quantize_static(float_path, int8_path, CalibrationData(), quant_format=QuantFormat.QDQ, per_channel=True,
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+
+
+def compare_predictions(reference, network, states, batch_size):
+    """
+    :param reference: network to compare with, e.g. the Keras model, with predict_on_batch
+    :param network: network to check, with predict_on_batch
+    :param np.ndarray states: input planes of the positions to compare on
+    :param int batch_size: positions per batch
+    :return dict(str,float): top1_agreement, the fraction of the positions where both networks have the same most
+        likely move, and value_mse, the mean squared difference of their values
+    """
+    same_top1, squared_error = 0, 0.0
+    for i in range(0, len(states), batch_size):
+        batch = states[i:i + batch_size]
+        policy, value = reference.predict_on_batch(batch)
+        other_policy, other_value = network.predict_on_batch(batch)
+        same_top1 += int(np.sum(np.argmax(policy, axis=1) == np.argmax(other_policy, axis=1)))
+        squared_error += float(np.sum((np.reshape(value, -1) - np.reshape(other_value, -1)) ** 2))
+    return {"top1_agreement": same_top1 / len(states), "value_mse": squared_error / len(states)}
+
+
+class OnnxNetwork:
+    """
+    An exported model run by onnxruntime on the CPU, which predicts like a Keras model for ShogiModelAPI
+
+    Attributes:
+        :ivar onnxruntime.InferenceSession session: the session running the model
+        :ivar str input_name: name of the input planes in the model
+    """
+
+    def __init__(self, path):
+        """
+        :param str path: path of the ONNX model
+        """
+        import onnxruntime
+        self.session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict_on_batch(self, data):
+        """
+        :param np.ndarray data: input planes of a batch of observations
+        :return (np.ndarray,np.ndarray): policies and values of the observations
+        """
+        policy, value = self.session.run(None, {self.input_name: np.asarray(data, dtype=np.float32)})
+        return policy, value
@@ -10,8 +10,10 @@ from threading import Lock
 import shogi
 import numpy as np
 
+from shogi_zero.agent.evaluation_cache import get_evaluation_cache, get_opening_cache
 from shogi_zero.config import Config
 from shogi_zero.env.shogi_env import ShogiEnv, Winner
+from shogi_zero.env.zobrist import zobrist_hash_after
 
 logger = getLogger(__name__)
 
@@ -20,42 +22,54 @@ logger = getLogger(__name__)
 class VisitStats:
     """
     Holds information for use by the AGZ MCTS algorithm on all moves from a given game state (this is generally used inside
-    of a defaultdict where a game state in FEN format maps to a VisitStats object).
-    Attributes:
-        :ivar defaultdict(ActionStats) a: known stats for all actions to take from the the state represented by
-            this visitstats.
-        :ivar int sum_n: sum of the n value for each of the actions in self.a, representing total
-            visits over all actions in self.a.
-    """
-
-    def __init__(self):
-        self.a = defaultdict(ActionStats)
-        self.sum_n = 0
-        #self.p = None
+    of a defaultdict where the zobrist key of a game state maps to a VisitStats object).
 
-
-class ActionStats:
-    """
-    Holds the stats needed for the AGZ MCTS algorithm for a specific action taken from a specific state.
+    The stats of the actions are kept in contiguous arrays, aligned with self.legal, so that selection is vectorized.
+    The legal moves are generated once, when the state is expanded, and then used by selection, by the
+    visit count policy and by the sampling of the move to play.
 
     Attributes:
-        :ivar int n: number of visits to this action by the algorithm
-        :ivar float w: every time a child of this action is visited by the algorithm,
+        :ivar list(shogi.Move) moves: legal moves from this state
+        :ivar np.ndarray legal: label index of each of the legal moves
+        :ivar np.ndarray n: number of visits to each action by the algorithm
+        :ivar np.ndarray w: every time a child of an action is visited by the algorithm,
             this accumulates the value (calculated from the value network) of that child. This is modified
             by a virtual loss which encourages threads to explore different nodes.
-        :ivar float q: mean action value (total value from all visits to actions
+        :ivar np.ndarray q: mean action value (total value from all visits to actions
             AFTER this action, divided by the total number of visits to this action)
             i.e. it's just w / n.
-        :ivar float p: prior probability of taking this action, given
-            by the policy network.
-
+        :ivar np.ndarray prior: prior probability of taking each action, given
+            by the policy network and normalized over the legal moves.
+        :ivar int sum_n: sum of self.n, representing total visits over all actions.
     """
 
     def __init__(self):
-        self.n = 0
-        self.w = 0
-        self.q = 0
-        self.p = 0
+        self.moves = None
+        self.legal = None
+        self.n = None
+        self.w = None
+        self.q = None
+        self.prior = None
+        self.sum_n = 0
+
+    @property
+    def expanded(self):
+        return self.legal is not None
+
+    def expand_edges(self, moves, legal, prior):
+        """
+        Creates the edges of the legal moves
+
+        :param list(shogi.Move) moves: legal moves from this state
+        :param np.ndarray legal: label index of each of the legal moves
+        :param np.ndarray prior: prior of each of the legal moves given by the policy network
+        """
+        self.moves = moves
+        self.legal = np.asarray(legal, dtype=np.intp)
+        self.prior = prior / (np.sum(prior) + 1e-8)
+        self.n = np.zeros(len(moves))
+        self.w = np.zeros(len(moves))
+        self.q = np.zeros(len(moves))
 
 
 class ShogiPlayer:
@@ -64,7 +78,8 @@ class ShogiPlayer:
     from a learned model on the other side of a pipe.
 
     Attributes:
-        :ivar list moves: stores info on the moves that have been performed during the game
+        :ivar list moves: stores info on the moves that have been performed during the game: the observation and
+            the sparse policy (label indices and probabilities of the moves with a non-zero probability)
         :ivar Config config: stores the whole config for how to run
         :ivar PlayConfig play_config: just stores the PlayConfig to use to play the game. Taken from the config
             if not specifically specified.
@@ -73,14 +88,20 @@ class ShogiPlayer:
         :ivar dict(str, int) move_lookup: dict from move label to its index in self.labels
         :ivar list(Connection) pipe_pool: the pipes to send the observations of the game to to get back
             value and policy predictions from
-        :ivar dict(str,Lock) node_lock: dict from SFEN game state to a Lock, indicating
+        :ivar dict(int,Lock) node_lock: dict from game state key to a Lock, indicating
             whether that state is currently being explored by another thread.
         :ivar VisitStats tree: holds all of the visited game states and actions
             during the running of the AGZ algorithm
+        :ivar dict(str,int) search_stats: number of network evaluations, of evaluations found in the evaluation
+            cache and in the opening cache, and of tree nodes and visits kept from the search of the previous move,
+            since the beginning of the game
+        :ivar EvaluationCache evaluation_cache: evaluations shared by all of the players of this process
+        :ivar str model_digest: digest of the model weights which made the last prediction
+        :ivar boolean use_opening_cache: whether to use the opening cache, only the players of the best model do
     """
     # dot = False
 
-    def __init__(self, config: Config, pipes=None, play_config=None, dummy=False):
+    def __init__(self, config: Config, pipes=None, play_config=None, dummy=False, use_opening_cache=True):
         self.moves = []
 
         self.tree = defaultdict(VisitStats)
@@ -89,9 +110,14 @@ class ShogiPlayer:
         self.labels_n = config.n_labels
         self.labels = config.labels
         self.move_lookup = {shogi.Move.from_usi(move): i for move, i in zip(self.labels, range(self.labels_n))}
+        self.search_stats = {"evaluations": 0, "cache_hits": 0, "opening_cache_hits": 0, "reused_nodes": 0,
+                             "reused_visits": 0}
         if dummy:
             return
 
+        self.evaluation_cache = get_evaluation_cache(self.play_config.evaluation_cache_size)
+        self.model_digest = None
+        self.use_opening_cache = use_opening_cache
         self.pipe_pool = pipes
         self.node_lock = defaultdict(Lock)
 
@@ -99,7 +125,49 @@ class ShogiPlayer:
         """
         reset the tree to begin a new exploration of states
         """
-        self.tree = defaultdict(VisitStats)
+        self.tree.clear()
+        self.node_lock.clear()
+
+    def share_tree_with(self, player):
+        """
+        Makes this player search in the same tree as another player, which must be using the same model.
+        The trees are cleared and pruned in place, so both players keep sharing it for the whole game.
+
+        :param ShogiPlayer player: the player whose tree to use
+        """
+        self.tree = player.tree
+        self.node_lock = player.node_lock
+
+    def prune_tree(self, env):
+        """
+        Keeps only the part of the tree that is reachable from the current state, i.e. the subtree under the
+        moves that were actually played since the previous search.
+
+        :param ShogiEnv env: environment at the new root
+        """
+        kept = {}
+        root = state_key(env)
+        if root in self.tree:
+            self._collect_subtree(shogi.Board(env.board.sfen()), root, kept)
+        self.tree.clear()
+        self.tree.update(kept)
+        self.node_lock.clear()
+        if root in kept:
+            self.search_stats["reused_nodes"] += len(kept)
+            self.search_stats["reused_visits"] += kept[root].sum_n
+
+    def _collect_subtree(self, board, state, kept):
+        my_visit_stats = self.tree[state]
+        kept[state] = my_visit_stats
+        if not my_visit_stats.expanded:
+            return
+        for action_t in np.flatnonzero(my_visit_stats.n > 0):  # only visited actions lead to known states
+            move = my_visit_stats.moves[action_t]
+            child = zobrist_hash_after(board, state, move)
+            if child in self.tree and child not in kept:
+                board.push(move)
+                self._collect_subtree(board, child, kept)
+                board.pop()
 
     def action(self, env, can_stop=True) -> str:
         """
@@ -109,26 +177,27 @@ class ShogiPlayer:
         :param ShogiEnv env: environment in which to figure out the action
         :param boolean can_stop: whether we are allowed to take no action (return None)
         :return: None if no action should be taken (indicating a resign). Otherwise, returns a string
-            indicating the action to take in usi format
+            indicating the action to take in usi format. The player resigns when the value of the root is below
+            PlayConfig.resign_threshold: the best mean value of its moves over all of their visits when the root
+            kept visits from the previous search, else the value search_moves returns.
         """
-        self.reset()
+        if self.play_config.reuse_tree:
+            self.prune_tree(env)
+        else:
+            self.reset()
+        key = state_key(env)
+        reused = key in self.tree and self.tree[key].sum_n > 0
 
         # for tl in range(self.play_config.thinking_loop):
-        root_value, naked_value = self.search_moves(env)
-        policy = self.calc_policy(env)
-
-        legal_moves = []
-        legal_policy = []
-        for mov in env.board.legal_moves:
-            idx = self.move_lookup[mov]
-            legal_moves.append(idx)
-            legal_policy.append(policy[idx])
-
-        if len(legal_policy) == 0:
+        root_value, _ = self.search_moves(env)
+        root = self.tree[key]
+        if not root.expanded or len(root.moves) == 0:
             return None
+        if reused:  # the values of this search alone would leave out the visits kept from the previous one
+            root_value = float(np.max(root.q[root.n > 0]))
 
-        my_action = int(np.random.choice(legal_moves,
-                                         p=self.apply_temperature(legal_policy, env.num_halfmoves)))
+        policy = self.calc_policy(env)
+        my_action = int(np.random.choice(root.legal, p=self.apply_temperature(policy, env.num_halfmoves)))
 
         if can_stop and self.play_config.resign_threshold is not None and \
                 root_value <= self.play_config.resign_threshold \
@@ -136,7 +205,9 @@ class ShogiPlayer:
             # noinspection PyTypeChecker
             return None
         else:
-            self.moves.append([env.observation, list(policy)])
+            visited = policy > 0
+            self.moves.append([env.observation, (root.legal[visited].astype(np.uint16),
+                                                 policy[visited].astype(np.float32))])
             #self.moves.append([env.observation, root_value])
             return self.config.labels[my_action]
 
@@ -150,15 +221,143 @@ class ShogiPlayer:
         :return (float,float): the maximum value of all values predicted by each thread,
             and the first value that was predicted.
         """
+        if self.play_config.batch_search:
+            return self.search_moves_batch(env)
+
+        # each simulation borrows one of these copies, and walks it down the tree and back with push/pop
+        env_pool = [env.copy() for _ in range(self.play_config.search_threads)]
+
+        def search_from_root():
+            search_env = env_pool.pop()
+            try:
+                return self.search_my_move(search_env, is_root_node=True)
+            finally:
+                env_pool.append(search_env)
+
         futures = []
         with ThreadPoolExecutor(max_workers=self.play_config.search_threads) as executor:
-            for _ in range(self.play_config.simulation_num_per_move):
-                futures.append(executor.submit(self.search_my_move, env=env.copy(), is_root_node=True))
+            for _ in range(self.num_simulations(env)):
+                futures.append(executor.submit(search_from_root))
 
         vals = [f.result() for f in futures]
 
         return np.max(vals), vals[0]  # vals[0] is kind of racy
 
+    def num_simulations(self, env) -> int:
+        """
+        :param ShogiEnv env: env to search for moves within
+        :return int: number of simulations to run, the visits kept from the previous search count
+            toward simulation_num_per_move
+        """
+        root = self.tree.get(state_key(env))
+        inherited = root.sum_n if root is not None else 0
+        return max(self.play_config.simulation_num_per_move - inherited, 1)
+
+    def search_moves_batch(self, env) -> (float, float):
+        """
+        Same as search_moves, but from a single thread: descends the tree search_threads times using virtual
+        loss, sends all of the collected leaves to the model as one request, then backs up all of the results.
+        The root is expanded first, on its own, else all the descents of the first batch would stop there.
+
+        :param ShogiEnv env: env to search for moves within
+        :return (float,float): the maximum value of all values predicted by each simulation,
+            and the first value that was predicted.
+        """
+        batch_size = self.play_config.search_threads
+        num_simulations = self.num_simulations(env)
+        vals = []
+        if not env.done and state_key(env) not in self.tree:
+            vals.append(self.expand_and_evaluate(env))
+
+        search_env = env.copy()  # walked down the tree and back with push/pop by each descent
+        while len(vals) < num_simulations:
+            num = min(batch_size, num_simulations - len(vals))
+            paths, leaf_states, leaf_values, leaves = [], [], [], {}
+            for _ in range(num):
+                path, state, leaf_v = self.select_leaf(search_env, leaves)
+                paths.append(path)
+                leaf_states.append(state)
+                leaf_values.append(leaf_v)
+
+            if leaves:
+                predictions = dict(zip(leaves.keys(), self.expand_and_evaluate_batch(list(leaves.values()))))
+                leaf_values = [v if state is None else predictions[state] for state, v in zip(leaf_states, leaf_values)]
+
+            for path, leaf_v in zip(paths, leaf_values):
+                vals.append(self.backup(path, leaf_v))
+
+        return np.max(vals), vals[0]
+
+    def select_leaf(self, env, leaves) -> (list, int, float):
+        """
+        Descends the tree from the root, applying virtual loss on the way, until it reaches a state that has not
+        been expanded yet or the end of the game. The moves are played with push and taken back before returning.
+
+        :param ShogiEnv env: environment at the root
+        :param dict(int,tuple) leaves: the leaves to evaluate found so far in this batch by state, see leaf_request,
+            to which the leaf is added if it has to be evaluated (a leaf reached twice is evaluated once)
+        :return (list((int,int)),int,float): the (state, action index) pairs that were followed,
+            and either the state of the leaf to evaluate (value None) or None and the value of the terminal leaf,
+            from the POV of the side to move at the leaf.
+        """
+        path = []
+        virtual_loss = self.play_config.virtual_loss
+        try:
+            while True:
+                if env.done:
+                    return path, None, 0 if env.winner == Winner.draw else -1
+                state = state_key(env)
+                if state not in self.tree:
+                    if state not in leaves:
+                        leaves[state] = self.leaf_request(env)
+                    return path, state, None
+                action_t = self.select_action_q_and_u(env, is_root_node=not path)
+                if action_t is None:
+                    return path, None, -1
+
+                my_visit_stats = self.tree[state]
+                my_visit_stats.sum_n += virtual_loss
+                my_visit_stats.n[action_t] += virtual_loss
+                my_visit_stats.w[action_t] += -virtual_loss
+                my_visit_stats.q[action_t] = my_visit_stats.w[action_t] / my_visit_stats.n[action_t]
+                path.append((state, action_t))
+                env.push(my_visit_stats.moves[action_t])
+        finally:
+            for _ in path:
+                env.pop()
+
+    def leaf_request(self, env) -> tuple:
+        """
+        :param ShogiEnv env: env at a leaf to evaluate
+        :return tuple: what expand_and_evaluate_batch needs to know of the leaf once env has moved on: its state,
+            legal moves and label indices, the cache keys (see cache_keys), and either the cached evaluation or
+            the input planes and canonical labels to predict it
+        """
+        moves, legal = env.legal_moves_and_labels()
+        cached = self.get_cached_evaluation(env, legal)
+        if cached is not None:
+            return state_key(env), moves, legal, None, cached, None, None
+        return (state_key(env), moves, legal, self.cache_keys(env), None, env.canonical_input_planes(),
+                canonical_labels(env, legal))
+
+    def backup(self, path, leaf_v) -> float:
+        """
+        Backs up the value of a leaf found by select_leaf along its path, removing the virtual loss.
+
+        :param list((int,int)) path: (state, action index) pairs from the root to the leaf
+        :param float leaf_v: value of the leaf from the POV of the side to move at the leaf
+        :return float: the value from the POV of the side to move at the root
+        """
+        virtual_loss = self.play_config.virtual_loss
+        for state, action_t in reversed(path):
+            leaf_v = -leaf_v
+            my_visit_stats = self.tree[state]
+            my_visit_stats.sum_n += -virtual_loss + 1
+            my_visit_stats.n[action_t] += -virtual_loss + 1
+            my_visit_stats.w[action_t] += virtual_loss + leaf_v
+            my_visit_stats.q[action_t] = my_visit_stats.w[action_t] / my_visit_stats.n[action_t]
+        return leaf_v
+
     def search_my_move(self, env: ShogiEnv, is_root_node=False) -> float:
         """
         Q, V is value for this Player(always white).
@@ -167,7 +366,8 @@ class ShogiPlayer:
         This method searches for possible moves, adds them to a search tree, and eventually returns the
         best move that was found during the search.
 
-        :param ShogiEnv env: environment in which to search for the move
+        :param ShogiEnv env: environment in which to search for the move, owned by the calling thread. The moves
+            played while descending are taken back before returning.
         :param boolean is_root_node: whether this is the root node of the search.
         :return float: value of the move. This is calculated by getting a prediction
             from the value network.
@@ -184,9 +384,7 @@ class ShogiPlayer:
         # print(env.board)
         with self.node_lock[state]:
             if state not in self.tree:
-                leaf_p, leaf_v = self.expand_and_evaluate(env)
-                self.tree[state].p = leaf_p
-                return leaf_v  # I'm returning everything from the POV of side to move
+                return self.expand_and_evaluate(env)  # I'm returning everything from the POV of side to move
             # SELECT STEP
             action_t = self.select_action_q_and_u(env, is_root_node)
             if action_t is None:
@@ -194,16 +392,18 @@ class ShogiPlayer:
             virtual_loss = self.play_config.virtual_loss
 
             my_visit_stats = self.tree[state]
-            my_stats = my_visit_stats.a[action_t]
 
             my_visit_stats.sum_n += virtual_loss
-            my_stats.n += virtual_loss
-            my_stats.w += -virtual_loss
-            my_stats.q = my_stats.w / my_stats.n
+            my_visit_stats.n[action_t] += virtual_loss
+            my_visit_stats.w[action_t] += -virtual_loss
+            my_visit_stats.q[action_t] = my_visit_stats.w[action_t] / my_visit_stats.n[action_t]
         # print(action_t)
         # print("---------")
-        env.step(action_t.usi())
-        leaf_v = self.search_my_move(env)  # next move from enemy POV
+        env.push(my_visit_stats.moves[action_t])
+        try:
+            leaf_v = self.search_my_move(env)  # next move from enemy POV
+        finally:
+            env.pop()
         leaf_v = -leaf_v
 
         # BACKUP STEP
@@ -211,68 +411,161 @@ class ShogiPlayer:
         # update: N, W, Q
         with self.node_lock[state]:
             my_visit_stats.sum_n += -virtual_loss + 1
-            my_stats.n += -virtual_loss + 1
-            my_stats.w += virtual_loss + leaf_v
-            my_stats.q = my_stats.w / my_stats.n
+            my_visit_stats.n[action_t] += -virtual_loss + 1
+            my_visit_stats.w[action_t] += virtual_loss + leaf_v
+            my_visit_stats.q[action_t] = my_visit_stats.w[action_t] / my_visit_stats.n[action_t]
 
         return leaf_v
 
-    def expand_and_evaluate(self, env) -> (np.ndarray, float):
+    def expand_and_evaluate(self, env) -> float:
         """ expand new leaf, this is called only once per state
         this is called with state locked
         insert P(a|s), return leaf_v
 
-        This gets a prediction for the policy and value of the state within the given env
-        :return (float, float): the policy and value predictions for this state
+        This gets a prediction for the policy and value of the state within the given env, and expands
+        the state with the priors of its legal moves
+        :return float: the value prediction for this state
+        """
+        moves, legal = env.legal_moves_and_labels()
+        cached = self.get_cached_evaluation(env, legal)
+        if cached is not None:
+            prior, leaf_v = cached
+        else:
+            state_planes = env.canonical_input_planes()
+
+            # the model gives the priors of the canonical labels (i.e. side to move is "white") of the legal moves,
+            # in the order of legal
+            prior, leaf_v = self.predict(state_planes, canonical_labels(env, legal))
+            self.search_stats["evaluations"] += 1
+            self.cache_evaluation(self.cache_keys(env), legal, prior, leaf_v)
+
+        self.tree[state_key(env)].expand_edges(moves, legal, prior)
+        return leaf_v
+
+    def expand_and_evaluate_batch(self, leaves) -> list:
+        """ same as expand_and_evaluate, for many leaves in one request
+
+        :param list(tuple) leaves: the leaves to evaluate, see leaf_request
+        :return list(float): the value predictions for each of the states
+        """
+        priors, leaf_vs = [None] * len(leaves), [None] * len(leaves)
+        to_predict = []
+        for i, (_, _, _, _, cached, _, _) in enumerate(leaves):
+            if cached is None:
+                to_predict.append(i)
+            else:
+                priors[i], leaf_vs[i] = cached
+
+        if to_predict:
+            state_planes = np.asarray([leaves[i][5] for i in to_predict], dtype=np.float32)
+            legal_labels = [leaves[i][6] for i in to_predict]
+
+            prior_list, value_ary = self.predict(state_planes, legal_labels)
+            self.search_stats["evaluations"] += len(to_predict)
+
+            for i, prior, leaf_v in zip(to_predict, prior_list, value_ary):
+                priors[i], leaf_vs[i] = prior, float(leaf_v)
+                self.cache_evaluation(leaves[i][3], leaves[i][2], prior, leaf_vs[i])
+
+        for (state, moves, legal, _, _, _, _), prior in zip(leaves, priors):
+            self.tree[state].expand_edges(moves, legal, prior)
+        return leaf_vs
+
+    def get_cached_evaluation(self, env, legal):
+        """
+        :param ShogiEnv env: env to look up
+        :param np.ndarray legal: label index of each of the legal moves of the state
+        :return (np.ndarray, float): the priors of the legal moves and the value of the state from the evaluation
+            cache or from the opening cache, None if it is in neither
         """
-        state_planes = env.canonical_input_planes()
+        if self.model_digest is None:
+            return None
+        if self.evaluation_cache is not None:
+            cached = self.evaluation_cache.get(self.model_digest, evaluation_key(env))
+            if cached is not None:
+                self.search_stats["cache_hits"] += 1
+                return cached
+
+        opening_cache = self.get_opening_cache(env)
+        if opening_cache is not None:
+            cached = opening_cache.get(env.key, opening_info(env))
+            if cached is not None and np.array_equal(cached[0], legal):
+                _, prior, leaf_v = cached
+                self.search_stats["opening_cache_hits"] += 1
+                if self.evaluation_cache is not None:
+                    self.evaluation_cache.put(self.model_digest, evaluation_key(env), prior, leaf_v)
+                return prior, leaf_v
+        return None
+
+    def cache_keys(self, env):
+        """
+        :param ShogiEnv env: env of the state
+        :return tuple: the evaluation key of the state, its opening cache (None if it is too deep), its state key
+            and its opening info, to cache its evaluation with
+        """
+        return evaluation_key(env), self.get_opening_cache(env), env.key, opening_info(env)
 
-        leaf_p, leaf_v = self.predict(state_planes)
-        # these are canonical policy and value (i.e. side to move is "white")
+    def cache_evaluation(self, cache_keys, legal, prior, leaf_v):
+        """
+        :param tuple cache_keys: keys of the state, see cache_keys
+        :param np.ndarray legal: label index of each of the legal moves of the state
+        :param np.ndarray prior: priors of the legal moves
+        :param float leaf_v: value of the state
+        """
+        key, opening_cache, state, info = cache_keys
+        if self.evaluation_cache is not None:
+            self.evaluation_cache.put(self.model_digest, key, prior, leaf_v)
 
-        if not env.white_to_move:
-            leaf_p = Config.flip_policy(leaf_p)  # get it back to python-shogi form
+        if opening_cache is not None:
+            opening_cache.put(state, info, legal, prior, leaf_v)
 
-        return leaf_p, leaf_v
+    def get_opening_cache(self, env):
+        """
+        :param ShogiEnv env: env to look up
+        :return OpeningCache: the opening cache of the current model if the state is shallow enough, else None
+        """
+        if not self.use_opening_cache or env.board.move_number > self.play_config.opening_cache_max_ply:
+            return None
+        return get_opening_cache(self.config.resource, self.model_digest, self.play_config.opening_cache_slots)
 
-    def predict(self, state_planes):
+    def predict(self, state_planes, legal_labels):
         """
         Gets a prediction from the policy and value network
-        :param state_planes: the observation state represented as planes
-        :return (float, float): policy (prior probability of taking the action leading to this state)
-            and value network (value of the state) prediction for this state.
+        :param state_planes: the observation state represented as planes, or a batch of them
+        :param legal_labels: canonical label indices of the legal moves of the state (see canonical_labels),
+            or a list of them for a batch
+        :return (np.ndarray, float): priors of the legal moves, normalized (prior probability of taking the
+            actions leading from this state), and value network (value of the state) prediction for this state.
+            For a batch, the list of the priors and the array of the values of every state.
         """
         pipe = self.pipe_pool.pop()
-        pipe.send(state_planes)
-        ret = pipe.recv()
+        pipe.send((state_planes, legal_labels))
+        policy, value, digest = pipe.recv()
         self.pipe_pool.append(pipe)
-        return ret
+        if digest != self.model_digest:
+            if self.model_digest is not None and self.evaluation_cache is not None:
+                self.evaluation_cache.invalidate(self.model_digest)  # weights were reloaded
+            self.model_digest = digest
+        return policy, value
 
-    def select_action_q_and_u(self, env, is_root_node) -> shogi.Move:
+    def select_action_q_and_u(self, env, is_root_node) -> int:
         """
         Picks the next action to explore using the AGZ MCTS algorithm.
 
         Picks based on the action which maximizes the maximum action value
-        (ActionStats.q) + an upper confidence bound on that action.
+        (VisitStats.q) + an upper confidence bound on that action.
 
         :param Environment env: env to look for the next moves within
         :param is_root_node: whether this is for the root node of the MCTS search.
-        :return shogi.Move: the move to explore
+        :return int: index of the move to explore in VisitStats.moves, None if there is no legal move
         """
         # this method is called with state locked
         state = state_key(env)
 
         my_visitstats = self.tree[state]
 
-        if my_visitstats.p is not None:  # push p to edges
-            tot_p = 1e-8
-            for mov in env.board.legal_moves:
-                mov_p = my_visitstats.p[self.move_lookup[mov]]
-                my_visitstats.a[mov].p = mov_p
-                tot_p += mov_p
-            for a_s in my_visitstats.a.values():
-                a_s.p /= tot_p
-            my_visitstats.p = None
+        if len(my_visitstats.moves) == 0:
+            return None
 
         xx_ = np.sqrt(my_visitstats.sum_n + 1)  # sqrt of sum(N(s, b); for all b)
 
@@ -280,23 +573,13 @@ class ShogiPlayer:
         c_puct = self.play_config.c_puct
         dir_alpha = self.play_config.dirichlet_alpha
 
-        best_s = -999
-        best_a = None
+        p_ = my_visitstats.prior
         if is_root_node:
-            noise = np.random.dirichlet([dir_alpha] * len(my_visitstats.a))
-
-        i = 0
-        for action, a_s in my_visitstats.a.items():
-            p_ = a_s.p
-            if is_root_node:
-                p_ = (1 - e) * p_ + e * noise[i]
-                i += 1
-            b = a_s.q + c_puct * p_ * xx_ / (1 + a_s.n)
-            if b > best_s:
-                best_s = b
-                best_a = action
+            noise = np.random.dirichlet([dir_alpha] * len(p_))
+            p_ = (1 - e) * p_ + e * noise
+        b = my_visitstats.q + c_puct * p_ * xx_ / (1 + my_visitstats.n)
 
-        return best_a
+        return int(np.argmax(b))
 
     def apply_temperature(self, policy, turn):
         """
@@ -321,13 +604,12 @@ class ShogiPlayer:
 
     def calc_policy(self, env):
         """calc π(a|s0)
-        :return list(float): a list of probabilities of taking each action, calculated based on visit counts.
+        :return np.ndarray: the probability of taking each of the legal moves of the state (in the order of
+            VisitStats.legal), calculated based on visit counts.
         """
         state = state_key(env)
         my_visitstats = self.tree[state]
-        policy = np.zeros(self.labels_n)
-        for action, a_s in my_visitstats.a.items():
-            policy[self.move_lookup[action]] = a_s.n
+        policy = np.asarray(my_visitstats.n, dtype=np.float64)
         policy /= np.sum(policy)
         return policy
 
@@ -340,12 +622,10 @@ class ShogiPlayer:
         :param float weight: weight to assign to the taken action when logging it in self.moves
         :return str: the action, unmodified.
         """
-        policy = np.zeros(self.labels_n)
-
         k = self.move_lookup[shogi.Move.from_usi(my_action)]
-        policy[k] = weight
+        policy = np.asarray([k], dtype=np.uint16), np.asarray([weight], dtype=np.float32)
 
-        self.moves.append([observation, list(policy)])
+        self.moves.append([observation, policy])
         return my_action
 
     def finish_game(self, z):
@@ -360,10 +640,42 @@ class ShogiPlayer:
             move += [z]
 
 
-def state_key(env: ShogiEnv) -> str:
+def evaluation_key(env: ShogiEnv) -> (int, int, int):
+    """
+    :param ShogiEnv env: env to encode
+    :return (int,int,int): the state key together with the move clock and the repetition count,
+        which are also inputs of the network
+    """
+    return env.key, env.board.move_number, env.count_same_state
+
+
+def opening_info(env: ShogiEnv) -> int:
+    """
+    :param ShogiEnv env: env to encode
+    :return int: the move clock and the repetition count packed in 32 bits, checked along with the state key
+        by the opening cache
+    """
+    return (env.board.move_number << 8) | min(env.count_same_state, 255)
+
+
+_UNFLIPPED_INDEX = np.asarray(Config.unflipped_index, dtype=np.uint16)
+
+
+def canonical_labels(env: ShogiEnv, legal) -> np.ndarray:
+    """
+    :param ShogiEnv env: env of the state
+    :param np.ndarray legal: label index of each of the legal moves of the state
+    :return np.ndarray: the index of the same moves in the policy of the network, which sees the board
+        from the side to move
+    """
+    if env.white_to_move:
+        return legal.astype(np.uint16)
+    return _UNFLIPPED_INDEX[legal]
+
+
+def state_key(env: ShogiEnv) -> int:
     """
     :param ShogiEnv env: env to encode
-    :return str: a str representation of the game state
+    :return int: the zobrist key of the game state (the move clock is not part of it)
     """
-    fen = env.board.sfen().rsplit(' ', 1)  # drop the move clock
-    return fen[0]
+    return env.key
@@ -0,0 +1,163 @@
+"""
+Shared memory transport between the players and ShogiModelAPI: the observations, the legal labels and the
+predictions are written in place in a slot of shared memory, and the pipe only carries tiny signals.
+"""
+import numpy as np
+
+from shogi_zero.env.consts import NUM_INPUT_PLANES
+
+MAX_LEGAL_MOVES = 600  # there are at most 593 legal moves in a shogi position
+
+
+class SharedMemorySlot:
+    """
+    Views over one block of shared memory, sized for a batch of observations of one player.
+
+    Attributes:
+        :ivar SharedMemory shm: the block of shared memory
+        :ivar int max_batch_size: max number of observations in a request
+        :ivar np.ndarray planes: input planes of each observation
+        :ivar np.ndarray num_moves: number of legal moves of each observation
+        :ivar np.ndarray labels: canonical label indices of the legal moves of each observation
+        :ivar np.ndarray priors: normalized priors of the legal moves of each observation, written by the server
+        :ivar np.ndarray values: value of each observation, written by the server
+    """
+    fields = [("planes", np.float32, (NUM_INPUT_PLANES, 9, 9)), ("priors", np.float32, (MAX_LEGAL_MOVES,)),
+              ("values", np.float32, ()), ("labels", np.uint16, (MAX_LEGAL_MOVES,)), ("num_moves", np.uint16, ())]
+
+    def __init__(self, max_batch_size, name=None, remote=False):
+        """
+        :param int max_batch_size: max number of observations in a request
+        :param str name: name of the block to attach to, None to create a new one
+        :param boolean remote: whether the block was created outside of this process tree (by the inference
+            server), in which case the resource tracker of this tree must not remove it when this process exits
+        """
+        # Python 3.8+, imported here so that the pipes alone still work on older versions
+        from multiprocessing import resource_tracker
+        from multiprocessing.shared_memory import SharedMemory
+
+        self.max_batch_size = max_batch_size
+        size = sum(max_batch_size * np.dtype(dtype).itemsize * int(np.prod(shape))
+                   for _, dtype, shape in self.fields)
+        if name is None:
+            self.shm = SharedMemory(create=True, size=size)
+        else:
+            self.shm = SharedMemory(name=name)
+            if remote:
+                resource_tracker.unregister(self.shm._name, "shared_memory")
+        offset = 0
+        for field, dtype, shape in self.fields:
+            view = np.ndarray((max_batch_size,) + shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+            setattr(self, field, view)
+            offset += view.nbytes
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def unlink(self):
+        """
+        Detaches from the block and removes it, it is freed once the other processes detached from it too.
+        The slot must not be used anymore.
+        """
+        for field, _, _ in self.fields:
+            setattr(self, field, None)
+        try:
+            self.shm.close()
+        except BufferError:  # views of the last request are still around, the block is unmapped once they are gone
+            pass
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+    def read_request(self, num):
+        """
+        :param int num: number of observations of a batch, 0 for a single observation
+        :return (np.ndarray,list(np.ndarray)|np.ndarray): the request, as it would have been sent through the pipe
+        """
+        legal_labels = [self.labels[i, :k] for i, k in enumerate(self.num_moves[:max(num, 1)])]
+        if num == 0:
+            return self.planes[0], legal_labels[0]
+        return self.planes[:num], legal_labels
+
+    def write_reply(self, priors, values):
+        """
+        :param list(np.ndarray) priors: priors of the legal moves of each of the observations of the request
+        :param np.ndarray values: value of each of the observations
+        """
+        for i, prior in enumerate(priors):
+            self.priors[i, :len(prior)] = prior
+        self.values[:len(values)] = values
+
+    def fits(self, state_planes, legal_labels):
+        """
+        :return boolean: whether a request fits in this slot, else it has to go through the pipe
+        """
+        return len(state_planes) <= self.max_batch_size and \
+            all(len(labels) <= MAX_LEGAL_MOVES for labels in legal_labels)
+
+
+class SharedMemoryConnection:
+    """
+    The player end of a shared memory slot of ShogiModelAPI, a drop-in replacement for the Connection of a pipe:
+    send takes a request (observations, legal labels) and recv returns the reply (priors, values, digest).
+
+    The request is written in the slot and only its number of observations is sent through the pipe, as the
+    number of observations of a batch or 0 for a single observation. The server writes the predictions in the
+    slot and sends back only the digest. Requests which do not fit in the slot go through the pipe as usual.
+
+    Attributes:
+        :ivar Connection conn: the pipe which carries the signals
+        :ivar str name: name of the shared memory block of the slot
+        :ivar int max_batch_size: max number of observations of a request
+        :ivar boolean remote: whether the slot belongs to the inference server rather than to this process tree
+        :ivar SharedMemorySlot slot: the slot, attached on first use in each process
+        :ivar (list(int),boolean) pending: number of legal moves of each observation of the request written in
+            the slot and whether it is a batch, None if the request in flight went through the pipe
+    """
+
+    def __init__(self, conn, name, max_batch_size, remote=False):
+        self.conn = conn
+        self.name = name
+        self.max_batch_size = max_batch_size
+        self.remote = remote
+        self.slot = None
+        self.pending = None
+
+    def __getstate__(self):
+        return {"conn": self.conn, "name": self.name, "max_batch_size": self.max_batch_size, "remote": self.remote}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def send(self, request):
+        state_planes, legal_labels = request
+        batch = state_planes.ndim == 4
+        if not batch:
+            state_planes, legal_labels = state_planes[np.newaxis], [legal_labels]
+        if self.slot is None:
+            self.slot = SharedMemorySlot(self.max_batch_size, self.name, self.remote)
+        if not self.slot.fits(state_planes, legal_labels):
+            self.pending = None
+            self.conn.send(request)
+            return
+
+        n = len(state_planes)
+        self.slot.planes[:n] = state_planes
+        for i, labels in enumerate(legal_labels):
+            self.slot.num_moves[i] = len(labels)
+            self.slot.labels[i, :len(labels)] = labels
+        self.pending = ([len(labels) for labels in legal_labels], batch)
+        self.conn.send(n if batch else 0)
+
+    def recv(self):
+        reply = self.conn.recv()
+        if self.pending is None:
+            return reply
+        (num_moves, batch), self.pending = self.pending, None
+        priors = [self.slot.priors[i, :k].copy() for i, k in enumerate(num_moves)]
+        values = self.slot.values[:len(num_moves)].copy()
+        if batch:
+            return priors, values, reply
+        return priors[0], float(values[0]), reply
@@ -60,6 +60,14 @@ class ResourceConfig:
         self.next_generation_model_dirname_tmpl = "model_%s"
         self.next_generation_model_config_filename = "model_config.json"
         self.next_generation_model_weight_filename = "model_weight.h5"
+        self.model_best_onnx_filename_tmpl = "model_best_%s.onnx"
+
+        self.evaluation_cache_dir = os.path.join(self.data_dir, "evaluation_cache")
+        self.evaluation_cache_filename_tmpl = "opening_%s.bin"
+        self.training_shard_dir = os.path.join(self.data_dir, "training_shards")
+
+        self.inference_server_address = os.path.join(self.data_dir, "inference_server.sock")
+        self.inference_server_authkey = b"shogi_zero"
 
         self.play_data_dir = os.path.join(self.data_dir, "play_data")
         self.play_data_filename_tmpl = "play_%s.pkl"
@@ -69,7 +77,7 @@ class ResourceConfig:
 
     def create_directories(self):
         dirs = [self.project_dir, self.data_dir, self.model_dir, self.play_data_dir, self.log_dir,
-                self.next_generation_model_dir]
+                self.next_generation_model_dir, self.evaluation_cache_dir, self.training_shard_dir]
         for d in dirs:
             if not os.path.exists(d):
                 os.makedirs(d)
@@ -142,6 +150,7 @@ class Config:
         :ivar PlayDataConfig play_date: configuration for the saved data from playing
         :ivar TrainerConfig trainer: config for how training should go
         :ivar EvaluateConfig eval: config for how evaluation should be done
+        :ivar ExportConfig export: config for how the best model is exported for inference
     """
     labels = create_uci_labels()
     n_labels = int(len(labels))
@@ -171,6 +180,7 @@ class Config:
         self.play_data = c.PlayDataConfig()
         self.trainer = c.TrainerConfig()
         self.eval = c.EvaluateConfig()
+        self.export = c.ExportConfig()
         self.labels = Config.labels
         self.n_labels = Config.n_labels
         # self.flipped_labels = Config.flipped_labels
@@ -184,6 +194,15 @@ class Config:
         """
         return np.asarray([pol[ind] for ind in Config.unflipped_index])
 
+    @staticmethod
+    def flip_sparse_policy(labels, probs):
+        """
+        :param np.ndarray labels: label indices of a sparse policy
+        :param np.ndarray probs: probabilities of the labels
+        :return (np.ndarray,np.ndarray): the sparse policy, flipped like flip_policy (the flip is its own inverse)
+        """
+        return np.asarray(Config.unflipped_index, dtype=np.uint16)[labels], probs
+
 
 Config.unflipped_index = [Config.labels.index(x) for x in Config.flipped_labels]
 
@@ -19,6 +19,16 @@ class EvaluateConfig:
         self.max_game_length = 1000
 
 
+class ExportConfig:
+    def __init__(self):
+        self.quantize = True  # also write an int8 model, calibrated on positions of the play data
+        self.calibration_positions = 1024  # positions the activation ranges of the int8 model are calibrated on
+        self.check_positions = 4096  # held-out positions the exported models are compared with the Keras model on
+        self.min_top1_agreement = 0.95  # the export fails below this top-1 move agreement of either exported model
+        self.max_value_mse = 1e-3  # or above this value mse
+        self.batch_size = 64
+
+
 class PlayDataConfig:
     def __init__(self):
         self.min_elo_policy = 500 # 0 weight
@@ -32,6 +42,19 @@ class PlayConfig:
     def __init__(self):
         self.max_processes = 3
         self.search_threads = 16
+        self.batch_search = False  # collect search_threads leaves per request from one thread
+        self.reuse_tree = True  # keep the subtree under the moves played since the previous search
+        self.share_tree = True  # in self-play, both sides search in one tree, kept between moves by reuse_tree
+        self.evaluation_cache_size = 2000  # network evaluations kept per process, 0 to disable
+        self.opening_cache_max_ply = 16  # positions up to this move number go to the on-disk opening cache
+        self.opening_cache_slots = 65536  # positions per opening cache file (~50MB), 0 to disable
+        self.shared_memory_transport = True  # pass observations and predictions to the model through shared memory
+        self.prediction_batch_size = 48  # observations which make the model server predict right away
+        self.prediction_max_wait = 0.002  # max seconds a request waits for its batch to fill
+        self.fold_batchnorm = True  # fold batch normalizations to predict, see bench_fold_batchnorm.py
+        self.inference_backend = "keras"  # or "onnx", "onnx_int8" to predict with the models of the "export" command
+        self.use_inference_server = False  # players get the best model's predictions from the "server" process
+        self.inference_server_reload_interval = 60  # seconds between checks of the server for a new best model
         self.vram_frac = 1.0
         self.simulation_num_per_move = 800
         self.thinking_loop = 1
@@ -53,10 +76,17 @@ class TrainerConfig:
         self.vram_frac = 1.0
         self.batch_size = 384 # tune this to your gpu memory
         self.epoch_to_checkpoint = 1
-        self.dataset_size = 100000
+        self.dataset_size = 100000  # positions trained on between two checkpoints
+        self.replay_window = 100  # newest play data files (generations) whose positions are kept for training
+        self.replay_buffer_size = 4000000  # most positions kept for training, about 300 bytes each
+        self.recency_weight = 0.98  # sampling weight of a generation relative to the next newer one
+        self.batch_loaders = 2  # processes which build the batches ahead of training
+        self.prefetch_batches = 8  # batches built ahead of training
+        self.validation_interval = 50  # every validation_interval-th play data file is held out to validate on
+        self.validation_size = 2000  # positions sampled from the held out files to validate on
         self.start_total_steps = 0
         self.save_model_steps = 25
-        self.load_data_steps = 100
+        self.load_data_steps = 100  # batches between two readings of the list of play data files
         self.loss_weights = [1.25, 1.0] # [policy, value] prevent value overfit in SL
 
 
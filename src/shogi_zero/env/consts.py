@@ -15,3 +15,7 @@ HANDABLE_PIECES = ["R", "B", "G", "S", "N", "L", "P"] + \
 NUM_HANDABLE_PIECES = len(HANDABLE_PIECES)
 
 HANDABLE_PIECES_IDX = {HANDABLE_PIECES[i]: i for i in range(NUM_HANDABLE_PIECES)}
+
+NUM_GAME_FEATURES = 2  # same state count and half turn count
+
+NUM_INPUT_PLANES = NUM_PIECES + NUM_HANDABLE_PIECES + NUM_GAME_FEATURES
@@ -4,7 +4,9 @@ and operating on the shogi environment.
 """
 import copy
 import enum
+import os
 from collections import defaultdict
+from functools import lru_cache
 import shogi
 import numpy as np
 
@@ -16,7 +18,10 @@ from .consts import (
     # HANDABLE_PIECES,
     NUM_HANDABLE_PIECES,
     HANDABLE_PIECES_IDX,
+    NUM_INPUT_PLANES,
 )
+from .zobrist import zobrist_hash, zobrist_hash_after
+from shogi_zero.config import Config
 
 from logging import getLogger
 logger = getLogger(__name__)
@@ -31,15 +36,24 @@ class ShogiEnv:
     Attributes:
         :ivar shogi.Board board: current board state
         :ivar int num_halfmoves: number of half moves performed in total by each player
+        :ivar int key: zobrist hash of the current position (board, hands and side to move)
+        :ivar defaultdict(int,int) map_count_state: number of times each position (by key) has been seen
+        :ivar int count_same_state: number of times the current position has been seen
+        :ivar list undo_stack: state to restore on pop, for each of the moves played by push
         :ivar Winner winner: winner of the game
         :ivar boolean resigned: whether non-winner resigned
         :ivar str result: str encoding of the result, 1-0, 0-1, or 1/2-1/2
     """
+    # cross-check every incremental key against a full recompute and the SFEN of the position
+    check_key = os.environ.get("SHOGI_ZERO_CHECK_KEY") == "1"
 
     def __init__(self):
         self.board = None
         self.num_halfmoves = 0
+        self.key = None
         self.map_count_state = None
+        self.count_same_state = 0
+        self.undo_stack = []
         self.winner = None  # type: Winner
         self.resigned = False
         self.result = None
@@ -52,7 +66,10 @@ class ShogiEnv:
         self.board = shogi.Board()
         self.num_halfmoves = 0
         self.map_count_state = defaultdict(int)
-        self.map_count_state[self.board.sfen().split(" ")[0]] += 1
+        self.key = zobrist_hash(self.board)
+        self.map_count_state[self.key] += 1
+        self.count_same_state = 1
+        self.undo_stack = []
         self.winner = None
         self.resigned = False
         return self
@@ -65,7 +82,10 @@ class ShogiEnv:
         """
         self.board = shogi.Board(board)
         self.map_count_state = defaultdict(int)
-        self.map_count_state[self.board.sfen().split(" ")[0]] += 1
+        self.key = zobrist_hash(self.board)
+        self.map_count_state[self.key] += 1
+        self.count_same_state = 1
+        self.undo_stack = []
         self.winner = None
         self.resigned = False
         return self
@@ -85,7 +105,7 @@ class ShogiEnv:
     def step(self, action: str, check_over=True):
         """
 
-        Takes an action and updates the game state
+        Takes an action and updates the game state. The action is checked, an illegal action resigns the game.
 
         :param str action: action to take in usi notation
         :param boolean check_over: whether to check if game is over
@@ -94,18 +114,81 @@ class ShogiEnv:
             self._resign()
             return
         try:
-            self.board.push_usi(action)
+            move = shogi.Move.from_usi(action)
         except ValueError:
             self._resign()
             return
-        board = self.board.sfen().split(" ")[0]
-        self.map_count_state[board] += 1
-        if check_over and self.map_count_state[board] >= 4:
+        if move not in self.board.legal_moves:
+            self._resign()
+            return
+        self.step_move(move, check_over)
+
+    def step_move(self, move, check_over=True):
+        """
+        Takes an action generated from board.legal_moves, e.g. by the search, and updates the game state.
+        Unlike step, the action is trusted: it is neither converted to usi notation nor checked.
+
+        :param shogi.Move|int move: move to take, or index of its label in Config.labels
+        :param boolean check_over: whether to check if game is over
+        """
+        if not isinstance(move, shogi.Move):
+            move = label_moves()[move]
+        key = zobrist_hash_after(self.board, self.key, move)
+        self.board.push(move)
+        self.key = key
+        if self.check_key:
+            self._check_key()
+        self.map_count_state[key] += 1
+        self.count_same_state = self.map_count_state[key]
+        if check_over and self.count_same_state >= 4:
             self.ending_average_game()
             return
 
         self.num_halfmoves += 1
 
+    def push(self, move, check_over=True):
+        """
+        Same as step_move, but the move can be taken back with pop. Used to walk down the search tree without
+        copying the environment.
+
+        :param shogi.Move|int move: move to take, or index of its label in Config.labels
+        :param boolean check_over: whether to check if game is over
+        """
+        self.undo_stack.append((self.key, self.count_same_state, self.num_halfmoves, self.winner, self.result))
+        self.step_move(move, check_over)
+
+    def pop(self):
+        """
+        Takes back the last move played by push
+        """
+        count = self.map_count_state[self.key] - 1
+        if count:
+            self.map_count_state[self.key] = count
+        else:
+            del self.map_count_state[self.key]
+        self.board.pop()
+        self.key, self.count_same_state, self.num_halfmoves, self.winner, self.result = self.undo_stack.pop()
+
+    def legal_moves_and_labels(self):
+        """
+        :return (list(shogi.Move), np.ndarray): the legal moves, and the index of the label of each of them
+            in Config.labels
+        """
+        moves = list(self.board.legal_moves)
+        legal = _label_index()[[hash(move) for move in moves]]
+        if (legal < 0).any():
+            unknown = [move.usi() for move, label in zip(moves, legal) if label < 0]
+            raise ValueError(f"legal moves without a label {unknown} at {self.board.sfen()}")
+        return moves, legal
+
+    def _check_key(self):
+        full_key = zobrist_hash(self.board)
+        if self.key != full_key:
+            raise RuntimeError(f"incremental key {self.key:x} != {full_key:x} at {self.board.sfen()}")
+        sfen = self.board.sfen().rsplit(' ', 1)[0]
+        if _checked_keys.setdefault(self.key, sfen) != sfen:
+            raise RuntimeError(f"key collision {self.key:x}: {_checked_keys[self.key]} and {sfen}")
+
     def _resign(self):
         self.resigned = True
         if self.white_to_move:  # WHITE RESIGNED!
@@ -151,12 +234,34 @@ class ShogiEnv:
 
         :return: a representation of the board using an (?, 9, 9) shape, good as input to a policy / value network
         """
-        sfen = self.board.sfen()
-        sfen_info = SfenInfo(sfen)
-        if not self.white_to_move:
-            sfen_info = sfen_info.get_flipped_sfen_info()
-        canonical_input = CanonicalInput(sfen_info, self.map_count_state[sfen_info.board])
-        return canonical_input.create()
+        return CanonicalInput.create_from_board(self.board, self.count_same_state)
+
+
+_checked_keys = {}  # key -> SFEN without move clock, filled only when ShogiEnv.check_key is set
+
+
+@lru_cache(maxsize=None)
+def label_moves():
+    """
+    :return list(shogi.Move): the move of each of the labels of Config.labels
+    """
+    return [shogi.Move.from_usi(label) for label in Config.labels]
+
+
+@lru_cache(maxsize=None)
+def _label_index():
+    """
+    :return np.ndarray: index in Config.labels of each move by hash of the move, -1 for the hashes of no label.
+        python-shogi packs the squares of a move in its hash, below 2 ** 15 and unique, so this avoids the
+        comparisons of a dict keyed by moves. That layout is checked here.
+    """
+    label_index = np.full(1 << 15, -1, dtype=np.intp)
+    for i, move in enumerate(label_moves()):
+        h = hash(move)
+        if not 0 <= h < len(label_index) or label_index[h] >= 0:
+            raise RuntimeError(f"unexpected hash {h} of the move {move.usi()}, python-shogi changed Move.__hash__")
+        label_index[h] = i
+    return label_index
 
 
 class SfenInfo:
@@ -173,6 +278,14 @@ class SfenInfo:
 
         self._flipped_sfen_info = None
 
+    @property
+    def position(self):
+        """
+        :return str: the sfen without the move number: the board, the side to move and the hands, which is what
+            repetitions are counted by, like the keys of ShogiEnv.map_count_state
+        """
+        return " ".join([self.board, self.turn, self.hand])
+
     def get_flipped_sfen_info(self):
         def swapcase(a):
             if a.isalpha():
@@ -218,14 +331,17 @@ class SfenInfo:
     def get_indexed_hand(self):
         indexed_hand = {}
         num = 1
+        prev_digit = False
         for s in self.hand:
             # no hand
             if s == '-':
                 break
 
             if s.isdigit():
-                num = int(s)
+                num = num * 10 + int(s) if prev_digit else int(s)
+                prev_digit = True
             else:
+                prev_digit = False
                 indexed_hand[HANDABLE_PIECES_IDX[s]] = num
                 num = 1
 
@@ -282,6 +398,152 @@ class CanonicalInput:
         turn_count_feature = np.full((9, 9), self.sfen_info.harf_turn_count, dtype=np.float32)
         return np.stack([count_same_state_feature, turn_count_feature])
 
+    @staticmethod
+    def create_batch(sfen_infos, counts_same_state):
+        """
+        Create canonical inputs for many positions at once. The output is identical to
+        stacking CanonicalInput(sfen_info, count).create() for every position.
+
+        :param list(SfenInfo) sfen_infos: SFENs that keep always player as a white player
+        :param list(int) counts_same_state: number of times each position has been seen
+        :return : (N, 44, 9, 9) representation of the game states
+        """
+        return CanonicalInput.expand_batch(*CanonicalInput.compact_batch(sfen_infos, counts_same_state))
+
+    @staticmethod
+    def compact_batch(sfen_infos, counts_same_state):
+        """
+        Compact form of the canonical inputs of many positions, about 100 bytes per position instead of the
+        14KB of the planes, which expand_batch turns into the planes.
+
+        :param list(SfenInfo) sfen_infos: SFENs that keep always player as a white player
+        :param list(int) counts_same_state: number of times each position has been seen
+        :return (np.ndarray,np.ndarray,np.ndarray,np.ndarray): (N, 81) uint8 piece index of each square,
+            (N, NUM_HANDABLE_PIECES) uint8 number of pieces in hand, (N,) uint16 same state counts and
+            (N,) uint16 half turn counts
+        """
+        indexed_boards = np.array([_indexed_board(info.board) for info in sfen_infos], dtype=np.uint8)
+        indexed_hands = np.array([_indexed_hand(info.hand) for info in sfen_infos], dtype=np.uint8)
+        return (indexed_boards.reshape((-1, 81)), indexed_hands.reshape((-1, NUM_HANDABLE_PIECES)),
+                np.asarray(counts_same_state, dtype=np.uint16).reshape(-1),
+                np.array([info.harf_turn_count for info in sfen_infos], dtype=np.uint16).reshape(-1))
+
+    @staticmethod
+    def expand_batch(indexed_boards, indexed_hands, counts_same_state, turn_counts):
+        """
+        :return : (N, 44, 9, 9) canonical inputs of positions in the compact form of compact_batch
+        """
+        n = len(indexed_boards)
+        planes = np.zeros((n, NUM_INPUT_PLANES, 81), dtype=np.float32)
+        planes[np.arange(n)[:, None], indexed_boards.astype(np.intp), _SQUARES] = 1
+        planes[:, NUM_PIECES:NUM_PIECES + NUM_HANDABLE_PIECES] = indexed_hands[:, :, None]
+        planes[:, -2] = counts_same_state[:, None]
+        planes[:, -1] = turn_counts[:, None]
+        return planes.reshape((n, NUM_INPUT_PLANES, 9, 9))
+
+    @staticmethod
+    def create_from_board(board, count_same_state):
+        """
+        Create canonical input directly from the bitboards and hands of a board, without going through
+        its SFEN. Gives the same planes as CanonicalInput(SfenInfo(board.sfen()), count).create(), with the
+        SFEN flipped first when black (gote) is to move.
+
+        :param shogi.Board board: position to encode
+        :param int count_same_state: number of times this position has been seen
+        :return : (44, 9, 9) representation of the game state
+        """
+        turn = board.turn
+        pieces = np.array(board.pieces, dtype=np.intp)
+        colors = _bitboard_to_array(board.occupied[shogi.WHITE])
+        indexed_board = _BOARD_PIECE_IDX[colors ^ turn, pieces]
+        if turn == shogi.WHITE:
+            indexed_board = indexed_board[_FLIPPED_SQUARES]
+
+        planes = np.zeros((NUM_INPUT_PLANES, 81), dtype=np.float32)
+        planes[indexed_board, _SQUARES] = 1
+        for color in shogi.COLORS:
+            offset = NUM_PIECES + (color ^ turn) * len(_HAND_PIECE_TYPES)
+            hand = board.pieces_in_hand[color]
+            for i, piece_type in enumerate(_HAND_PIECE_TYPES):
+                if hand[piece_type]:
+                    planes[offset + i] = hand[piece_type]
+        planes[-2] = count_same_state
+        planes[-1] = board.move_number
+        return planes.reshape((NUM_INPUT_PLANES, 9, 9))
+
+
+_SQUARES = np.arange(81)
+
+# rank a <-> rank i, as in SfenInfo.get_flipped_sfen_info
+_FLIPPED_SQUARES = np.array([(8 - sq // 9) * 9 + sq % 9 for sq in range(81)], dtype=np.intp)
+
+_HAND_PIECE_TYPES = [shogi.ROOK, shogi.BISHOP, shogi.GOLD, shogi.SILVER, shogi.KNIGHT, shogi.LANCE, shogi.PAWN]
+
+
+def _create_board_piece_idx():
+    """
+    :return np.ndarray: (color, piece_type) -> index in PIECES. Empty squares are 0, as in
+        SfenInfo.get_indexed_board.
+    """
+    table = np.zeros((len(shogi.COLORS), len(shogi.PIECE_TYPES) + 1), dtype=np.intp)
+    for color in shogi.COLORS:
+        for piece_type in shogi.PIECE_TYPES:
+            table[color, piece_type] = PICCES_IDX[shogi.Piece(piece_type, color).symbol()]
+    return table
+
+
+_BOARD_PIECE_IDX = _create_board_piece_idx()
+
+
+def _bitboard_to_array(bb):
+    """
+    :param int bb: bitboard
+    :return np.ndarray: 0/1 value of each of the 81 squares
+    """
+    bits = np.unpackbits(np.frombuffer(bb.to_bytes(11, "little"), dtype=np.uint8), bitorder="little")
+    return bits[:81].astype(np.intp)
+
+
+@lru_cache(maxsize=None)
+def _indexed_row(row):
+    """
+    :param str row: one rank of the SFEN board part
+    :return tuple(int): piece index of each of the 9 squares. Empty squares are 0, as in
+        SfenInfo.get_indexed_board, which the trained models depend on.
+    """
+    indexed_row = []
+    promoted = False
+    for c in row:
+        if c.isdigit():
+            indexed_row.extend([0] * int(c))
+        elif c == '+':
+            promoted = True
+        else:
+            indexed_row.append(PICCES_IDX['+' + c if promoted else c])
+            promoted = False
+    return tuple(indexed_row)
+
+
+def _indexed_board(board):
+    """
+    :param str board: board part of a SFEN
+    :return list(int): piece index of each of the 81 squares
+    """
+    indexed_board = []
+    for row in board.split("/"):
+        indexed_board.extend(_indexed_row(row))
+    return indexed_board
+
+
+@lru_cache(maxsize=4096)
+def _indexed_hand(hand):
+    """
+    :param str hand: hand part of a SFEN
+    :return tuple(int): number of pieces in hand, ordered as HANDABLE_PIECES
+    """
+    indexed_hand = SfenInfo("- - " + hand + " 0").get_indexed_hand()
+    return tuple(indexed_hand.get(i, 0) for i in range(NUM_HANDABLE_PIECES))
+
 
 '''
 def check_current_planes(realfen, planes):
@@ -0,0 +1,82 @@
+"""
+64-bit Zobrist hashing of shogi positions, covering the board, the pieces in hand and the side to move.
+The move clock is not part of the hash.
+"""
+import numpy as np
+import shogi
+
+MAX_PIECES_IN_HAND = 18
+
+
+def _random_keys(random_state, *shape):
+    """
+    :return list: nested lists of random 64-bit python ints with the given shape
+    """
+    size = int(np.prod(shape))
+    keys = np.frombuffer(random_state.bytes(8 * size), dtype=np.uint64).reshape(shape)
+    return keys.tolist()
+
+
+def _create_keys(seed=20171029):
+    random_state = np.random.RandomState(seed)
+    piece_square_keys = _random_keys(random_state, len(shogi.COLORS), len(shogi.PIECE_TYPES) + 1, 81)
+    hand_keys = _random_keys(random_state, len(shogi.COLORS), len(shogi.PIECE_TYPES) + 1, MAX_PIECES_IN_HAND + 1)
+    turn_key = _random_keys(random_state, 1)[0]
+    for color in shogi.COLORS:
+        piece_square_keys[color][shogi.NONE] = [0] * 81
+        for keys in hand_keys[color]:
+            keys[0] = 0  # a piece type that is not in hand does not change the hash
+    return piece_square_keys, hand_keys, turn_key
+
+
+PIECE_SQUARE_KEYS, HAND_KEYS, TURN_KEY = _create_keys()
+
+
+def zobrist_hash(board):
+    """
+    Computes the hash of a position from scratch.
+
+    :param shogi.Board board: position to hash
+    :return int: 64-bit hash
+    """
+    key = TURN_KEY if board.turn == shogi.WHITE else 0
+    white = board.occupied[shogi.WHITE]
+    for square, piece_type in enumerate(board.pieces):
+        if piece_type:
+            key ^= PIECE_SQUARE_KEYS[(white >> square) & 1][piece_type][square]
+    for color in shogi.COLORS:
+        for piece_type, num in board.pieces_in_hand[color].items():
+            key ^= HAND_KEYS[color][piece_type][num]
+    return key
+
+
+def zobrist_hash_after(board, key, move):
+    """
+    Computes incrementally the hash of the position reached by a move. Must be called before the move is pushed.
+
+    :param shogi.Board board: position before the move
+    :param int key: hash of board
+    :param shogi.Move move: move about to be pushed
+    :return int: hash of the position after the move
+    """
+    color = board.turn
+    hand = board.pieces_in_hand[color]
+    to_square = move.to_square
+    if move.drop_piece_type:
+        piece_type = move.drop_piece_type
+        num = hand[piece_type]
+        key ^= HAND_KEYS[color][piece_type][num] ^ HAND_KEYS[color][piece_type][num - 1]
+    else:
+        piece_type = board.pieces[move.from_square]
+        key ^= PIECE_SQUARE_KEYS[color][piece_type][move.from_square]
+        captured = board.pieces[to_square]
+        if captured:
+            key ^= PIECE_SQUARE_KEYS[color ^ 1][captured][to_square]
+            if captured >= shogi.PROM_PAWN:
+                captured = shogi.PIECE_PROMOTED.index(captured)
+            num = hand[captured]
+            key ^= HAND_KEYS[color][captured][num] ^ HAND_KEYS[color][captured][num + 1]
+        if move.promotion:
+            piece_type = shogi.PIECE_PROMOTED[piece_type]
+    key ^= PIECE_SQUARE_KEYS[color][piece_type][to_square]
+    return key ^ TURN_KEY
@@ -8,6 +8,8 @@ from datetime import datetime
 from glob import glob
 from logging import getLogger
 import pickle
+
+import numpy as np
 import shogi
 #import pyperclip
 from shogi_zero.config import ResourceConfig
@@ -46,6 +48,10 @@ def get_next_generation_model_dirs(rc: ResourceConfig):
 
 
 def write_game_data_to_file(path, data):
+    """
+    :param str path: path of the play data file
+    :param data: the play data, format is SelfPlayWorker.buffer (sparse policies)
+    """
     with open(path, "wb") as f:
         pickle.dump(data, f, -1)
 
@@ -53,3 +59,19 @@ def write_game_data_to_file(path, data):
 def read_game_data_from_file(path):
     with open(path, "rb") as f:
         return pickle.load(f)
+
+
+def sparse_policy(policy):
+    """
+    Reads the policy of a play data record, sparse as the players write it, or dense as in the files written
+    before: the probability of each label
+
+    :param policy: (label indices, probabilities), or the list of the probability of each label
+    :return (np.ndarray,np.ndarray): label indices (uint16) and probabilities (float32) of the policy
+    """
+    if isinstance(policy, tuple):
+        labels, probs = policy
+        return np.asarray(labels, dtype=np.uint16), np.asarray(probs, dtype=np.float32)
+    policy = np.asarray(policy, dtype=np.float32)
+    labels = np.flatnonzero(policy)
+    return labels.astype(np.uint16), policy[labels]
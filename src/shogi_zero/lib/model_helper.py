@@ -4,6 +4,8 @@ Helper methods for working with trained models.
 
 from logging import getLogger
 
+from shogi_zero.agent.evaluation_cache import remove_stale_opening_caches
+
 logger = getLogger(__name__)
 
 
@@ -21,7 +23,8 @@ def save_as_best_model(model):
     :param shogi_zero.agent.model.ChessModel model:
     :return:
     """
-    return model.save(model.config.resource.model_best_config_path, model.config.resource.model_best_weight_path)
+    model.save(model.config.resource.model_best_config_path, model.config.resource.model_best_weight_path)
+    remove_stale_opening_caches(model.config.resource, model.digest)
 
 
 def reload_best_model_weight_if_changed(model):
@@ -31,12 +34,15 @@ def reload_best_model_weight_if_changed(model):
     :return:
     """
     if model.config.model.distributed:
-        return load_best_model_weight(model)
+        loaded = load_best_model_weight(model)
     else:
         logger.debug("start reload the best model if changed")
         digest = model.fetch_digest(model.config.resource.model_best_weight_path)
-        if digest != model.digest:
-            return load_best_model_weight(model)
-
-        logger.debug("the best model is not changed")
-        return False
+        if digest == model.digest:
+            logger.debug("the best model is not changed")
+            return False
+        loaded = load_best_model_weight(model)
+
+    if loaded:
+        remove_stale_opening_caches(model.config.resource, model.digest)
+    return loaded
@@ -0,0 +1,46 @@
+"""
+Helper methods to hand out the pipes to the models to the processes of a ProcessPoolExecutor.
+
+Each worker process of the pool gets its own group of pipes, by its index, and keeps it for all the games it
+plays: it plays one game at a time, so it never shares its pipes, and borrowing them costs nothing. The groups
+are set in this module before the pool forks its processes, and each process claims the next index on its first
+call to worker_pipes (the initializer of ProcessPoolExecutor needs Python 3.7). Use them as
+
+    share_pipes({"cur": pipe_groups})
+    ProcessPoolExecutor(max_workers=len(pipe_groups))
+
+then worker_pipes("cur") in the tasks.
+"""
+from multiprocessing import Value
+
+_pipe_groups = None
+_counter = None
+_pipes = {}
+
+
+def share_pipes(pipe_groups):
+    """
+    Sets the groups of pipes of the processes of the next pool, which must be created (forked) after this call
+
+    :param dict(str,list(list(Connection))) pipe_groups: for each model, as many groups of pipes as workers
+    """
+    global _pipe_groups, _counter
+    _pipe_groups = pipe_groups
+    _counter = Value("i", 0)  # number of workers which claimed their groups, shared by the pool
+    _pipes.clear()
+
+
+def worker_pipes(name):
+    """
+    :param str name: model of the pipes, a key of the pipe_groups given to share_pipes
+    :return list(Connection): the pipes of this worker process to this model
+    """
+    if not _pipes:
+        if _pipe_groups is None:
+            raise RuntimeError("no pipes were shared before the pool forked this process, see share_pipes")
+        with _counter.get_lock():
+            index = _counter.value
+            _counter.value += 1
+        for model, groups in _pipe_groups.items():
+            _pipes[model] = groups[index]
+    return _pipes[name]
@@ -0,0 +1,15 @@
+"""
+Helper methods for the features which pass arrays between processes through multiprocessing.shared_memory, which
+needs Python 3.8+. On older versions they fall back to what they did before: pipes, or work done in one process.
+"""
+
+
+def has_shared_memory():
+    """
+    :return boolean: whether multiprocessing.shared_memory can be imported
+    """
+    try:
+        import multiprocessing.shared_memory  # noqa: F401
+    except ImportError:
+        return False
+    return True
@@ -1,6 +1,7 @@
 """
 For helping to configure tensorflow
 """
+from contextlib import contextmanager
 
 
 def set_session_config(per_process_gpu_memory_fraction=None, allow_growth=None):
@@ -22,3 +23,29 @@ def set_session_config(per_process_gpu_memory_fraction=None, allow_growth=None):
     )
     sess = tf.Session(config=config)
     k.set_session(sess)
+
+
+def new_graph_session():
+    """
+    Creates a session on a new graph, to build a model on while another thread predicts with the graph of Keras:
+    building ops in a graph is not thread safe.
+
+    :return tf.Session: the session, with the config Keras gives its own
+    """
+    import tensorflow as tf
+
+    return tf.Session(graph=tf.Graph(), config=tf.ConfigProto(allow_soft_placement=True))
+
+
+@contextmanager
+def graph_session_scope(session):
+    """
+    Builds and runs the ops of Keras in the graph of a session, in the thread it is entered in
+
+    :param tf.Session session: the session, e.g. of new_graph_session, None for the graph and session of Keras
+    """
+    if session is None:
+        yield
+    else:
+        with session.graph.as_default(), session.as_default():
+            yield
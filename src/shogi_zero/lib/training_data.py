@@ -0,0 +1,690 @@
+"""
+Training data of the optimize worker: the conversion of the play data into model inputs and targets, the
+training shards they are converted to once, the replay buffer of the last generations of play data and the
+stream of batches sampled from it that the model is trained on.
+"""
+import json
+import os
+import shutil
+from collections import defaultdict, deque
+from glob import glob
+from logging import getLogger
+from multiprocessing import Pipe, Process
+from time import sleep
+
+import numpy as np
+
+from shogi_zero.config import Config
+from shogi_zero.env.consts import NUM_INPUT_PLANES
+from shogi_zero.env.shogi_env import SfenInfo, CanonicalInput
+from shogi_zero.lib.data_helper import get_game_data_filenames, read_game_data_from_file, sparse_policy
+from shogi_zero.lib.shared_memory_helper import has_shared_memory
+
+logger = getLogger(__name__)
+
+
+class TrainingDataStream:
+    """
+    Endless stream of training batches sampled from a replay buffer of the play data, for Model.fit_generator, so
+    that training starts as soon as the first files are converted and goes on while the next files are.
+
+    The play data files are converted into training shards (see load_shard) by a long-lived pool of processes,
+    the executor; a file which did not change since its shard was written is not converted again. Each shard comes
+    back as a block of shared memory, which is added to the ReplayBuffer as one generation: the play data files
+    are numbered in the order they were written, as each holds the games of the best model of the time. The list
+    of files is read again every TrainerConfig.load_data_steps batches, to add the files written since. Every
+    TrainerConfig.validation_interval-th file is held out: its positions go to a buffer of their own, which the
+    batches are never sampled from, to validate on.
+
+    The TrainerConfig.batch_loaders loader processes of the stream build the next TrainerConfig.prefetch_batches
+    batches while the model trains: the positions are sampled here, and expanded to model inputs and targets by
+    a loader (see load_batch), straight from the blocks of the replay buffer into a slot, a block of shared memory
+    of the stream. Only the rows of the positions and the names of the blocks go through the pipes.
+
+    Without multiprocessing.shared_memory (Python 3.8+), or without loaders, the shards are memory mapped by the
+    stream and added as they are, and the batches are built in this process, see take.
+
+    Attributes:
+        :ivar Config config: config, for the resources and the TrainerConfig
+        :ivar ProcessPoolExecutor executor: processes which convert the files
+        :ivar boolean shared: whether the shards are passed around in blocks of shared memory
+        :ivar ReplayBuffer buffer: the positions the batches are sampled from, in blocks of shared memory, else
+            in memory mapped TrainingShards
+        :ivar ReplayBuffer held_out: the positions of the held out files, to validate on
+        :ivar dict(str,int) generations: generation of each of the files seen so far
+        :ivar deque((str,Future)) loading: files being converted, with the conversion
+        :ivar list(Process) loaders: processes which build the batches
+        :ivar list(Connection) loader_pipes: pipe to each of the loaders
+        :ivar deque((SharedArrays,Connection)) prefetched: batches being built, with their slot and the pipe to
+            the loader building it
+        :ivar list(SharedArrays) free_slots: slots of the batches which are not being built
+        :ivar list((int,SharedArrays)) retired: blocks of the positions evicted from the replay buffer, with the
+            number of batches which have to be built before they are unlinked, as they may be read until then
+        :ivar int submitted: number of batches submitted to the loaders so far
+        :ivar int done: number of batches built so far
+        :ivar int batches: number of batches taken since the list of files was read
+    """
+
+    def __init__(self, config: Config, executor):
+        """
+        :param Config config: config, for the resources and the TrainerConfig
+        :param ProcessPoolExecutor executor: processes to convert the files with
+        """
+        self.config = config
+        self.executor = executor
+        self.shared = has_shared_memory() and config.trainer.batch_loaders > 0
+        if not self.shared:
+            logger.info("the batches are built in the optimize worker, the loaders need Python 3.8+")
+        self.buffer = ReplayBuffer(config.trainer.replay_window, config.trainer.replay_buffer_size,
+                                   config.trainer.recency_weight)
+        self.held_out = ReplayBuffer(config.trainer.replay_window, config.trainer.replay_buffer_size)
+        self.generations = {}
+        self.loading = deque()
+        self.loaders = []
+        self.loader_pipes = []
+        for _ in range(config.trainer.batch_loaders if self.shared else 0):
+            pipe, loader_pipe = Pipe()
+            loader = Process(target=run_batch_loader, args=(loader_pipe,), daemon=True)
+            loader.start()
+            self.loaders.append(loader)
+            self.loader_pipes.append(pipe)
+        self.prefetched = deque()
+        self.free_slots = []
+        self.retired = []
+        self.submitted = 0
+        self.done = 0
+        self.batches = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """
+        :return (np.ndarray,list(np.ndarray)): the next batch, as inputs and [policy targets, value targets]
+        """
+        tc = self.config.trainer
+        if not self.shared:
+            states, policies, values = self.take(tc.batch_size)
+            return states, [policies, values]
+        self._update(tc.batch_size)
+        while len(self.prefetched) < tc.prefetch_batches:
+            self._prefetch(tc.batch_size)
+        slot, pipe = self.prefetched.popleft()
+        num = pipe.recv()
+        if isinstance(num, Exception):
+            raise num
+        self.done += 1
+        states, policies, values = (slot.arrays[field][:num].copy() for field in ("states", "policies", "values"))
+        self.free_slots.append(slot)
+        self._unlink_retired()
+        self._prefetch(tc.batch_size)
+        return states, [policies, values]
+
+    def take(self, num):
+        """
+        :param int num: number of positions
+        :return (np.ndarray,np.ndarray,np.ndarray): states, policies and values of num positions sampled from the
+            replay buffer, grouped by shard, built in this process. These are the batches of the stream when it
+            has no loaders.
+        """
+        self._update(num)
+        return self.buffer.sample(num, self.config.n_labels)
+
+    def take_held_out(self, num):
+        """
+        :param int num: number of positions
+        :return (np.ndarray,np.ndarray,np.ndarray): states, policies and values of num positions sampled from the
+            held out files, which are never trained on, built in this process
+        """
+        self._update(1, held_out=True)
+        return self.held_out.sample(num, self.config.n_labels)
+
+    def close(self):
+        """
+        Stops the loaders and unlinks the blocks of shared memory of the stream
+        """
+        for pipe in self.loader_pipes:
+            pipe.send(None)
+        for loader in self.loaders:
+            loader.join()
+        for block in [slot for slot, _ in self.prefetched] + self.free_slots + self.buffer.clear() + \
+                self.held_out.clear() + [block for _, block in self.retired]:
+            self._release(block)
+        self.loaders, self.loader_pipes, self.free_slots, self.retired = [], [], [], []
+        self.prefetched.clear()
+
+    def _update(self, num, held_out=False):
+        """
+        Adds the shards of the files which were converted to the replay buffer, and waits for more until it has
+        enough positions to take num of them
+
+        :param int num: number of positions to take
+        :param boolean held_out: whether to wait for the positions of the held out files instead
+        """
+        if self.batches % self.config.trainer.load_data_steps == 0:
+            self._read_filenames()
+        self.batches += 1
+        self._add_loaded_shards(wait=False)
+        buffer, num = (self.held_out, num) if held_out else \
+            (self.buffer, max(num, self.config.trainer.min_data_size_to_learn))
+        while len(buffer) < num:
+            if self.loading:
+                self._add_loaded_shards(wait=True)
+            else:
+                logger.info("There is not enough play data to train on")
+                sleep(60)
+                self._read_filenames()
+
+    def _prefetch(self, num):
+        """
+        Sends a batch of num positions to build to the next loader
+        """
+        if not self.free_slots:
+            self.free_slots.append(SharedArrays(batch_slot_layout(num, self.config.n_labels)))
+        slot = self.free_slots.pop()
+        pipe = self.loader_pipes[self.submitted % len(self.loader_pipes)]
+        sources = [(block.name, block.layout, rows) for _, block, rows in self.buffer.sample_rows(num)]
+        pipe.send((sources, slot.name, slot.layout))
+        self.prefetched.append((slot, pipe))
+        self.submitted += 1
+
+    def _unlink_retired(self):
+        """
+        Unlinks the retired blocks which no batch being built may read
+        """
+        for submitted, block in self.retired:
+            if submitted <= self.done:
+                self._release(block)
+        self.retired = [(submitted, block) for submitted, block in self.retired if submitted > self.done]
+
+    def _add_loaded_shards(self, wait):
+        """
+        Adds the shards of the files which were converted to the replay buffer
+
+        :param boolean wait: whether to wait for the conversion of the next file if it is not done
+        """
+        while self.loading and (wait or self.loading[0][1].done()):
+            filename, future = self.loading.popleft()
+            block = self._open_shard(future.result())
+            generation = self.generations[filename]
+            if block is not None and generation % self.config.trainer.validation_interval == 0:
+                for evicted in self.held_out.add(block.arrays, generation, block):
+                    self._release(evicted)  # the loaders never read the held out blocks
+                logger.debug(f"held out {filename}: {len(self.held_out)} positions to validate on")
+            elif block is not None:
+                for evicted in self.buffer.add(block.arrays, generation, block):
+                    self.retired.append((self.submitted, evicted))
+                self._unlink_retired()
+                logger.debug(f"replay buffer: {len(self.buffer)} positions of {self.buffer.num_games()} games, "
+                             f"{self.buffer.nbytes() / 2 ** 20:.0f}MB")
+            wait = False
+
+    def _open_shard(self, loaded):
+        """
+        :param loaded: what the conversion of a file returned, see load_shard, or update_shard without shared memory
+        :return SharedArrays|TrainingShard: the positions of the file, None if it has none
+        """
+        if not self.shared:
+            path, num = loaded
+            return TrainingShard(path) if num else None
+        return None if loaded is None else SharedArrays(loaded[1], name=loaded[0])
+
+    def _release(self, block):
+        """
+        Unlinks a block of positions or of a batch which is not used anymore, a TrainingShard is just dropped
+        """
+        if self.shared:
+            block.unlink()
+
+    def _read_filenames(self):
+        """
+        Numbers the files written since the list of files was last read and starts the conversion of those in
+        the window of generations of the replay buffer
+        """
+        rc = self.config.resource
+        filenames = get_game_data_filenames(rc)
+        remove_stale_shards(rc, filenames)
+        new_filenames = [filename for filename in filenames if filename not in self.generations]
+        for filename in new_filenames:
+            self.generations[filename] = len(self.generations)
+        newest = len(self.generations) - 1
+        for filename in new_filenames:
+            if self.generations[filename] > newest - self.config.trainer.replay_window:
+                logger.debug(f"loading data from {filename}")
+                convert = load_shard if self.shared else update_shard
+                self.loading.append((filename, self.executor.submit(convert, rc, filename)))
+        self.batches = 0
+
+
+class ReplayBuffer:
+    """
+    Positions of the last generations of play data, in the compact form of TrainingShard held in memory (about
+    300 bytes per position), along with the generation and the game of each position. A generation older than the
+    window of the newest generations is evicted, and so are the oldest ones when there are more positions than
+    the size of the buffer. The positions are sampled with replacement, each generation weighted by
+    recency_weight to the power of the number of generations it is older than the newest one.
+
+    Attributes:
+        :ivar int window: number of newest generations kept
+        :ivar int size: most positions kept, in whole generations (the newest one is always kept)
+        :ivar float recency_weight: sampling weight of a generation relative to the next newer one
+        :ivar list((int,dict(str,np.ndarray),object)) chunks: generation and arrays of the fields of TrainingShard
+            of the positions added together, with "games", the game of each position, and the source they were
+            added with, ordered by generation
+        :ivar int next_game: number given to the next game added
+        :ivar np.ndarray weights: sampling probability of each chunk, None until it is computed again
+    """
+
+    def __init__(self, window, size, recency_weight=1.0):
+        """
+        :param int window: number of newest generations kept
+        :param int size: most positions kept
+        :param float recency_weight: sampling weight of a generation relative to the next newer one, 1 to sample
+            every position alike
+        """
+        self.window = window
+        self.size = size
+        self.recency_weight = recency_weight
+        self.chunks = []
+        self.next_game = 0
+        self.weights = None
+
+    def __len__(self):
+        return sum(len(arrays["values"]) for _, arrays, _ in self.chunks)
+
+    def num_games(self):
+        """
+        :return int: number of games the positions are from
+        """
+        return sum(len(np.unique(arrays["games"])) for _, arrays, _ in self.chunks)
+
+    def nbytes(self):
+        """
+        :return int: memory used by the positions
+        """
+        return sum(array.nbytes for _, arrays, _ in self.chunks for array in arrays.values())
+
+    def add(self, arrays, generation, source=None):
+        """
+        Adds positions of consecutive games (a new game starts where the turn count does not increase), and evicts
+        the positions which are out of the window or the size of the buffer
+
+        :param dict(str,np.ndarray) arrays: arrays of the fields of TrainingShard of the positions, in memory
+        :param int generation: generation of the positions
+        :param source: what the arrays belong to, given back when they are evicted
+        :return list: the sources of the positions which were evicted
+        """
+        new_games = np.diff(arrays["turn_counts"].astype(np.int64), prepend=np.iinfo(np.int64).max) <= 0
+        arrays = dict(arrays, games=(self.next_game + np.cumsum(new_games) - 1).astype(np.int32))
+        self.next_game += int(new_games.sum())
+
+        chunks = sorted(self.chunks + [(generation, arrays, source)], key=lambda chunk: chunk[0])
+        newest = chunks[-1][0]
+        self.chunks = [chunk for chunk in chunks if chunk[0] > newest - self.window]
+        while len(self) > self.size and self.chunks[0][0] < newest:
+            oldest = self.chunks[0][0]
+            self.chunks = [chunk for chunk in self.chunks if chunk[0] != oldest]
+        self.weights = None
+        return [chunk[2] for chunk in chunks if not any(chunk is kept for kept in self.chunks)]
+
+    def clear(self):
+        """
+        :return list: the sources of all the positions, which are evicted
+        """
+        sources = [source for _, _, source in self.chunks]
+        self.chunks = []
+        self.weights = None
+        return sources
+
+    def sample_rows(self, num):
+        """
+        :param int num: number of positions
+        :return list((dict(str,np.ndarray),object,np.ndarray)): arrays and source of the chunks of num positions
+            sampled with replacement, and the rows of the positions in them
+        """
+        if self.weights is None:
+            newest = self.chunks[-1][0]
+            weights = np.array([len(arrays["values"]) * self.recency_weight ** (newest - generation)
+                                for generation, arrays, _ in self.chunks])
+            self.weights = weights / weights.sum()
+        chunk_indices = np.random.choice(len(self.chunks), size=num, p=self.weights)
+        samples = []
+        for index, count in zip(*np.unique(chunk_indices, return_counts=True)):
+            _, arrays, source = self.chunks[index]
+            samples.append((arrays, source, np.random.randint(len(arrays["values"]), size=count)))
+        return samples
+
+    def sample(self, num, n_labels):
+        """
+        :param int num: number of positions
+        :param int n_labels: number of labels of the policies
+        :return (np.ndarray,np.ndarray,np.ndarray): states, dense policies and values of num positions sampled
+            with replacement, grouped by chunk
+        """
+        batches = [expand_positions(arrays, rows, n_labels) for arrays, _, rows in self.sample_rows(num)]
+        return tuple(np.concatenate(arrays) for arrays in zip(*batches))
+
+
+class SharedArrays:
+    """
+    Arrays laid out one after the other in one block of shared memory, so that the loader processes and the
+    optimize worker see the same arrays: the positions of the replay buffer, and the batches built from them.
+
+    Attributes:
+        :ivar SharedMemory shm: the block of shared memory
+        :ivar list((str,str,tuple)) layout: field, dtype and shape of each of the arrays, in the order of the block
+        :ivar dict(str,np.ndarray) arrays: views of the arrays over the block, by field
+    """
+
+    def __init__(self, layout, name=None):
+        """
+        :param list((str,str,tuple)) layout: field, dtype and shape of each of the arrays
+        :param str name: name of the block to attach to, None to create a new one
+        """
+        from multiprocessing.shared_memory import SharedMemory  # Python 3.8+, only the optimizer needs it
+
+        self.layout = layout
+        offsets = []
+        size = 0
+        for _, dtype, shape in layout:
+            size += -size % 8  # aligns every array
+            offsets.append(size)
+            size += np.dtype(dtype).itemsize * int(np.prod(shape))
+        self.shm = SharedMemory(create=True, size=max(size, 1)) if name is None else SharedMemory(name=name)
+        self.arrays = {field: np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+                       for (field, dtype, shape), offset in zip(layout, offsets)}
+
+    @staticmethod
+    def copy_of(arrays):
+        """
+        :param dict(str,np.ndarray) arrays: arrays to copy
+        :return SharedArrays: a new block holding a copy of the arrays
+        """
+        block = SharedArrays([(field, array.dtype.str, array.shape) for field, array in arrays.items()])
+        for field, array in arrays.items():
+            block.arrays[field][...] = array
+        return block
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def close(self):
+        """
+        Detaches from the block, which must not be used by this process anymore
+        """
+        self.arrays = {}
+        self.shm.close()
+
+    def unlink(self):
+        """
+        Detaches from the block and removes it, once no other process uses it
+        """
+        self.close()
+        self.shm.unlink()
+
+
+def batch_slot_layout(num, n_labels):
+    """
+    :param int num: number of positions of a batch
+    :param int n_labels: number of labels of the policies
+    :return list((str,str,tuple)): layout of the SharedArrays a loader process writes a batch to (see load_batch):
+        states, dense policies and values of the positions
+    """
+    return [("states", "<f4", (num, NUM_INPUT_PLANES, 9, 9)), ("policies", "<f4", (num, n_labels)),
+            ("values", "<f4", (num,))]
+
+
+def run_batch_loader(pipe):
+    """
+    Main loop of a loader process of TrainingDataStream: builds the batches received through the pipe, and sends
+    back the number of positions of each (or the exception which prevented it), until it receives None
+
+    :param Connection pipe: pipe to the stream
+    """
+    while True:
+        request = pipe.recv()
+        if request is None:
+            break
+        try:
+            pipe.send(load_batch(*request))
+        except Exception as e:
+            pipe.send(e)
+    for block in _attached_blocks.values():
+        block.close()
+
+
+_attached_blocks = {}
+
+
+def load_batch(sources, slot_name, slot_layout):
+    """
+    Builds a batch in a loader process: expands positions of blocks of the replay buffer into a batch slot. The
+    blocks stay attached for the next batches as long as they are sampled from.
+
+    :param list((str,list,np.ndarray)) sources: name and layout of blocks of the replay buffer, and the rows of the
+        positions in each of them
+    :param str slot_name: name of the block of the slot to write the batch to
+    :param list slot_layout: layout of the slot, see batch_slot_layout
+    :return int: number of positions of the batch
+    """
+    names = set(name for name, _, _ in sources) | {slot_name}
+    for name in list(_attached_blocks):
+        if name not in names:
+            _attached_blocks.pop(name).close()
+    for name, layout in [(name, layout) for name, layout, _ in sources] + [(slot_name, slot_layout)]:
+        if name not in _attached_blocks:
+            _attached_blocks[name] = SharedArrays(layout, name=name)
+
+    slot = _attached_blocks[slot_name].arrays
+    n_labels = slot["policies"].shape[1]
+    num = 0
+    for name, _, rows in sources:
+        states, policies, values = expand_positions(_attached_blocks[name].arrays, rows, n_labels)
+        slot["states"][num:num + len(rows)] = states
+        slot["policies"][num:num + len(rows)] = policies
+        slot["values"][num:num + len(rows)] = values
+        num += len(rows)
+    return num
+
+
+class TrainingShard:
+    """
+    The training data of one play data file in compact form, memory mapped: for each position, the compact
+    canonical input of CanonicalInput.compact_batch, the sparse policy target (label indices and probabilities,
+    in the rows of policy_offsets) and the value target. Written by update_shard, one .npy file per field, and an
+    index written last, which records the play data file the shard was converted from.
+
+    Attributes:
+        :ivar str path: directory of the shard
+        :ivar dict(str,np.ndarray) arrays: the memory mapped arrays, by field
+    """
+    fields = ["indexed_boards", "indexed_hands", "counts_same_state", "turn_counts", "values", "policy_offsets",
+              "policy_labels", "policy_probs"]
+    version = 2  # of the conversion, the shards of an older one are converted again
+
+    def __init__(self, path):
+        """
+        :param str path: directory of the shard
+        """
+        self.path = path
+        self.arrays = {field: np.load(os.path.join(path, field + ".npy"), mmap_mode="r") for field in self.fields}
+
+    def __len__(self):
+        return len(self.arrays["values"])
+
+
+def expand_positions(arrays, rows, n_labels):
+    """
+    :param dict(str,np.ndarray) arrays: arrays of the fields of TrainingShard
+    :param np.ndarray rows: rows of the positions
+    :param int n_labels: number of labels of the policies
+    :return (np.ndarray,np.ndarray,np.ndarray): states, dense policies and values of the positions
+    """
+    a = arrays
+    states = CanonicalInput.expand_batch(a["indexed_boards"][rows], a["indexed_hands"][rows],
+                                         a["counts_same_state"][rows], a["turn_counts"][rows])
+
+    starts, ends = a["policy_offsets"][rows], a["policy_offsets"][rows + 1]
+    lengths = ends - starts
+    entries = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    policies = np.zeros((len(rows), n_labels), dtype=np.float32)
+    policies[np.repeat(np.arange(len(rows)), lengths), a["policy_labels"][entries]] = a["policy_probs"][entries]
+    return states, policies, np.asarray(a["values"][rows])
+
+
+def shard_path(rc, filename):
+    """
+    :param ResourceConfig rc: resources, to find the shard directory
+    :param str filename: play data file
+    :return str: directory of the training shard of the file
+    """
+    return os.path.join(rc.training_shard_dir, os.path.splitext(os.path.basename(filename))[0])
+
+
+def update_shard(rc, filename):
+    """
+    Converts a play data file into its training shard, unless the shard was converted from the file as it is now
+
+    :param ResourceConfig rc: resources, to find the shard directory
+    :param str filename: play data file
+    :return (str,int): directory of the shard and its number of positions
+    """
+    path = shard_path(rc, filename)
+    stat = os.stat(filename)
+    source = {"source": filename, "mtime_ns": stat.st_mtime_ns, "size": stat.st_size,
+              "version": TrainingShard.version}
+    try:
+        with open(os.path.join(path, "index.json"), "rt") as f:
+            index = json.load(f)
+        if index["source"] == source:
+            return path, index["positions"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    arrays = load_compact_data_from_file(filename)
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for field, array in zip(TrainingShard.fields, arrays):
+        np.save(os.path.join(tmp_path, field + ".npy"), array)
+    with open(os.path.join(tmp_path, "index.json"), "wt") as f:
+        json.dump({"source": source, "positions": len(arrays[0])}, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+    return path, len(arrays[0])
+
+
+def remove_stale_shards(rc, filenames):
+    """
+    Removes the training shards of the play data files which were removed
+
+    :param ResourceConfig rc: resources, to find the shard directory
+    :param list(str) filenames: the play data files
+    """
+    paths = set(shard_path(rc, filename) for filename in filenames)
+    for path in glob(os.path.join(rc.training_shard_dir, "*")):
+        if path not in paths and not path.endswith(".tmp"):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def load_shard(rc, filename):
+    """
+    Converts a play data file into its training shard (see update_shard), and copies the shard to a new block of
+    shared memory, which the caller attaches to and unlinks
+
+    :param ResourceConfig rc: resources, to find the shard directory
+    :param str filename: play data file
+    :return (str,list)|None: name and layout (see SharedArrays) of the block, None if the file has no positions
+    """
+    path, num = update_shard(rc, filename)
+    if not num:
+        return None
+    block = SharedArrays.copy_of(TrainingShard(path).arrays)
+    block.close()
+    return block.name, block.layout
+
+
+def load_data_from_file(filename):
+    data = read_game_data_from_file(filename)
+    try:
+        return convert_to_cheating_data(data)
+    except KeyError as e:
+        return None, None, None
+    except TypeError as e:
+        return None, None, None
+
+
+def load_compact_data_from_file(filename):
+    """
+    :param str filename: play data file
+    :return tuple(np.ndarray): the arrays of the fields of TrainingShard, empty if the file has no valid data
+    """
+    data = read_game_data_from_file(filename)
+    try:
+        return convert_to_compact_data(data)
+    except (KeyError, TypeError):
+        return convert_to_compact_data([])
+
+
+def convert_to_cheating_data(data):
+    """
+    :param data: format is SelfPlayWorker.buffer, or with the dense policies of the files written before
+    :return:
+    """
+    sfen_info_list, count_list, policy_list, value_list = _canonical_positions(data)
+    state_ary = CanonicalInput.create_batch(sfen_info_list, count_list)
+    policy_ary = np.zeros((len(policy_list), Config.n_labels), dtype=np.float32)
+    for policy, (labels, probs) in zip(policy_ary, policy_list):
+        policy[labels] = probs
+    return state_ary, policy_ary, np.asarray(value_list, dtype=np.float32)
+
+
+def convert_to_compact_data(data):
+    """
+    :param data: format is SelfPlayWorker.buffer, or with the dense policies of the files written before
+    :return tuple(np.ndarray): the arrays of the fields of TrainingShard, the same positions and targets as
+        convert_to_cheating_data with the policies kept sparse
+    """
+    sfen_info_list, count_list, policy_list, value_list = _canonical_positions(data)
+    policy_offsets = np.zeros(len(policy_list) + 1, dtype=np.int64)
+    np.cumsum([len(labels) for labels, _ in policy_list], out=policy_offsets[1:])
+    return CanonicalInput.compact_batch(sfen_info_list, count_list) + (
+        np.asarray(value_list, dtype=np.float32), policy_offsets,
+        np.concatenate([labels for labels, _ in policy_list] + [np.zeros(0, dtype=np.uint16)]),
+        np.concatenate([probs for _, probs in policy_list] + [np.zeros(0, dtype=np.float32)]))
+
+
+def _canonical_positions(data):
+    """
+    :param data: format is SelfPlayWorker.buffer, or with the dense policies of the files written before
+    :return (list(SfenInfo),list(int),list((np.ndarray,np.ndarray)),list(float)): the positions from the point
+        of view of the player to move, the number of times each was seen, and the sparse policy (see
+        sparse_policy) and value targets
+    """
+    sfen_info_list = []
+    count_list = []
+    policy_list = []
+    value_list = []
+    map_count_state = defaultdict(int)
+    for aaa in data:
+        state_sfen, policy, value = aaa
+        sfen_info = SfenInfo(state_sfen)
+        map_count_state[sfen_info.position] += 1
+        same_state_count = map_count_state[sfen_info.position]
+        if sfen_info.turn == 'w':
+            sfen_info = sfen_info.get_flipped_sfen_info()
+
+        policy = sparse_policy(policy)
+        if sfen_info.turn == 'w':
+            policy = Config.flip_sparse_policy(*policy)
+
+        move_number = int(state_sfen.split(' ')[3])
+        value_certainty = min(5, move_number) / 5  # reduces the noise of the opening... plz train faster
+        sl_value = value * value_certainty
+
+        sfen_info_list.append(sfen_info)
+        count_list.append(same_state_count)
+        policy_list.append(policy)
+        value_list.append(sl_value)
+    return sfen_info_list, count_list, policy_list, value_list
@@ -11,7 +11,7 @@ from .config import Config
 
 logger = getLogger(__name__)
 
-CMD_LIST = ['self', 'opt', 'eval', 'sl', 'uci']
+CMD_LIST = ['self', 'opt', 'eval', 'sl', 'uci', 'server', 'export']
 
 
 def create_parser():
@@ -74,3 +74,9 @@ def start():
     elif args.cmd == 'uci':
         from .play_game import uci
         return uci.start(config)
+    elif args.cmd == 'server':
+        from .worker import inference_server
+        return inference_server.start(config)
+    elif args.cmd == 'export':
+        from .worker import export
+        return export.start(config)
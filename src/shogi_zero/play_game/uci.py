@@ -61,6 +61,9 @@ def start(config: Config):
 
 
 def get_player(config):
+    if config.play.use_inference_server:
+        from shogi_zero.agent.api_shogi import connect_to_server
+        return ShogiPlayer(config, connect_to_server(config.resource, config.play))
     from shogi_zero.agent.model_shogi import ShogiModel
     from shogi_zero.lib.model_helper import load_best_model_weight
     model = ShogiModel(config)
@@ -5,15 +5,16 @@ Encapsulates the worker which evaluates newly-trained models and picks the best
 import os
 from concurrent.futures import ProcessPoolExecutor, as_completed
 from logging import getLogger
-from multiprocessing import Manager
 from time import sleep
 
+from shogi_zero.agent.api_shogi import connect_to_server
 from shogi_zero.agent.model_shogi import ShogiModel
 from shogi_zero.agent.player_shogi import ShogiPlayer
 from shogi_zero.config import Config
 from shogi_zero.env.shogi_env import ShogiEnv, Winner
 from shogi_zero.lib.data_helper import get_next_generation_model_dirs, pretty_print
 from shogi_zero.lib.model_helper import save_as_best_model, load_best_model_weight
+from shogi_zero.lib.pipe_helper import share_pipes, worker_pipes
 
 logger = getLogger(__name__)
 
@@ -29,10 +30,10 @@ class EvaluateWorker:
     Attributes:
         :ivar Config config: config to use for evaluation
         :ivar PlayConfig config: PlayConfig to use to determine how to play, taken from config.eval.play_config
-        :ivar ShogiModel current_model: currently chosen best model
-        :ivar Manager m: multiprocessing manager
-        :ivar list(Connection) cur_pipes: pipes on which the current best ShogiModel is listening which will be used to
-            make predictions while playing a game.
+        :ivar ShogiModel current_model: currently chosen best model, None with PlayConfig.use_inference_server
+            until a next generation model replaces it
+        :ivar list(list(Connection)) cur_pipes: pipes on which the current best ShogiModel is listening which will be
+            used to make predictions while playing a game, one group of search_threads pipes per process.
     """
 
     def __init__(self, config: Config):
@@ -41,10 +42,8 @@ class EvaluateWorker:
         """
         self.config = config
         self.play_config = config.eval.play_config
-        self.current_model = self.load_current_model()
-        self.m = Manager()
-        self.cur_pipes = self.m.list([self.current_model.get_pipes(self.play_config.search_threads)
-                                      for _ in range(self.play_config.max_processes)])
+        self.current_model = None if self.play_config.use_inference_server else self.load_current_model()
+        self.cur_pipes = [self.get_current_pipes() for _ in range(self.play_config.max_processes)]
 
     def start(self):
         """
@@ -54,7 +53,10 @@ class EvaluateWorker:
         while True:
             ng_model, model_dir = self.load_next_generation_model()
             logger.debug(f"start evaluate model {model_dir}")
-            ng_is_great = self.evaluate_model(ng_model)
+            try:
+                ng_is_great = self.evaluate_model(ng_model)
+            finally:
+                ng_model.close_pipes()  # its players are gone, frees its shared memory
             if ng_is_great:
                 logger.debug(f"New Model become best model: {model_dir}")
                 save_as_best_model(ng_model)
@@ -68,28 +70,35 @@ class EvaluateWorker:
         :param ShogiModel ng_model: model to evaluate
         :return: true iff this model is better than the current_model
         """
-        ng_pipes = self.m.list([ng_model.get_pipes(self.play_config.search_threads)
-                                for _ in range(self.play_config.max_processes)])
+        ng_pipes = [ng_model.get_pipes(self.play_config.search_threads) for _ in range(self.play_config.max_processes)]
 
         futures = []
+        share_pipes({"cur": self.cur_pipes, "ng": ng_pipes})
         with ProcessPoolExecutor(max_workers=self.play_config.max_processes) as executor:
             for game_idx in range(self.config.eval.game_num):
-                fut = executor.submit(play_game, self.config, cur=self.cur_pipes,
-                                      ng=ng_pipes, current_white=(game_idx % 2 == 0))
+                fut = executor.submit(play_game, self.config, current_white=(game_idx % 2 == 0))
                 futures.append(fut)
 
             results = []
             for fut in as_completed(futures):
                 # ng_score := if ng_model win -> 1, lose -> 0, draw -> 0.5
-                ng_score, env, current_white = fut.result()
+                ng_score, env, current_white, search_stats = fut.result()
                 results.append(ng_score)
                 win_rate = sum(results) / len(results)
                 game_idx = len(results)
                 logger.debug(f"game {game_idx:3}: ng_score={ng_score:.1f} as {'black' if current_white else 'white'} "
                              f"{'by resign ' if env.resigned else '          '}"
                              f"win_rate={win_rate*100:5.1f}% "
+                             f"evaluations={search_stats['evaluations']} cache hits={search_stats['cache_hits']} "
+                             f"opening cache hits={search_stats['opening_cache_hits']} "
+                             f"reused nodes={search_stats['reused_nodes']} visits={search_stats['reused_visits']} "
                              f"{env.board.sfen().split(' ')[0]}")
 
+                if "cache" in search_stats:
+                    cache_stats = search_stats["cache"]
+                    logger.debug(f"evaluation cache: hit_rate={cache_stats['hit_rate'] * 100:5.1f}% "
+                                 f"entries={cache_stats['entries']} memory={cache_stats['bytes'] / 2 ** 20:.1f}MiB")
+
                 colors = ("current_model", "ng_model")
                 if not current_white:
                     colors = reversed(colors)
@@ -106,6 +115,16 @@ class EvaluateWorker:
         logger.debug(f"winning rate {win_rate*100:.1f}%")
         return win_rate >= self.config.eval.replace_rate
 
+    def get_current_pipes(self):
+        """
+        Get the pipes of one player of the current model, to its own model or to the inference server, which
+        serves the best model. The next generation model is always local.
+        :return list(Connection): search_threads pipes
+        """
+        if self.play_config.use_inference_server:
+            return connect_to_server(self.config.resource, self.play_config)
+        return self.current_model.get_pipes(self.play_config.search_threads)
+
     def move_model(self, model_dir):
         """
         Moves the newest model to the specified directory
@@ -145,24 +164,24 @@ class EvaluateWorker:
         return model, model_dir
 
 
-def play_game(config, cur, ng, current_white: bool) -> (float, ShogiEnv, bool):
+def play_game(config, current_white: bool) -> (float, ShogiEnv, bool, dict):
     """
-    Plays a game against models cur and ng and reports the results.
+    Plays a game between the current model and the next generation model, with the pipes of this process to
+    each of them, and reports the results.
 
     :param Config config: config for how to play the game
-    :param ShogiModel cur: should be the current model
-    :param ShogiModel ng: should be the next generation model
     :param bool current_white: whether cur should play white or black
-    :return (float, ShogiEnv, bool): the score for the ng model
-        (0 for loss, .5 for draw, 1 for win), the env after the game is finished, and a bool
-        which is true iff cur played as white in that game.
+    :return (float, ShogiEnv, bool, dict(str,int)): the score for the ng model
+        (0 for loss, .5 for draw, 1 for win), the env after the game is finished, a bool
+        which is true iff cur played as white in that game, and the search stats of both players summed.
     """
-    cur_pipes = cur.pop()
-    ng_pipes = ng.pop()
+    cur_pipes = worker_pipes("cur")
+    ng_pipes = worker_pipes("ng")
     env = ShogiEnv().reset()
 
     current_player = ShogiPlayer(config, pipes=cur_pipes, play_config=config.eval.play_config)
-    ng_player = ShogiPlayer(config, pipes=ng_pipes, play_config=config.eval.play_config)
+    # the opening cache is only kept for the best model
+    ng_player = ShogiPlayer(config, pipes=ng_pipes, play_config=config.eval.play_config, use_opening_cache=False)
     if current_white:
         white, black = current_player, ng_player
     else:
@@ -183,6 +202,7 @@ def play_game(config, cur, ng, current_white: bool) -> (float, ShogiEnv, bool):
         ng_score = 0
     else:
         ng_score = 1
-    cur.append(cur_pipes)
-    ng.append(ng_pipes)
-    return ng_score, env, current_white
+    search_stats = {k: white.search_stats[k] + black.search_stats[k] for k in white.search_stats}
+    if white.evaluation_cache is not None:
+        search_stats["cache"] = white.evaluation_cache.stats()
+    return ng_score, env, current_white, search_stats
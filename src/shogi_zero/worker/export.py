@@ -0,0 +1,103 @@
+"""
+Holds the worker which exports the best model for inference: to ONNX, and quantized to int8.
+"""
+import os
+from logging import getLogger
+from random import Random
+
+import numpy as np
+
+from shogi_zero.agent.model_shogi import ShogiModel
+from shogi_zero.agent.onnx_model import OnnxNetwork, compare_predictions, export_onnx, onnx_model_path, \
+    quantize_onnx, remove_stale_onnx_models
+from shogi_zero.config import Config
+from shogi_zero.lib.data_helper import get_game_data_filenames
+from shogi_zero.lib.model_helper import load_best_model_weight
+from shogi_zero.lib.training_data import load_data_from_file
+
+logger = getLogger(__name__)
+
+
+def start(config: Config):
+    return ExportWorker(config).start()
+
+
+class ExportWorker:
+    """
+    Worker which writes the best model as ONNX models next to its Keras files, named by the digest of its
+    weights: the model (its predict-only copy with PlayConfig.fold_batchnorm), and with ExportConfig.quantize its
+    int8 quantization, calibrated on positions of the play data. Both are checked against the Keras model on other
+    positions of the play data, and removed if either predicts further from it than ExportConfig allows.
+    PlayConfig.inference_backend makes the api predict with them.
+
+    Attributes:
+        :ivar Config config: config to use to configure this worker
+    """
+
+    def __init__(self, config: Config):
+        self.config = config
+
+    def start(self):
+        """
+        Export the best model and log how close the exported models predict to it. Raises RuntimeError, once the
+        exported models are removed, if they predict too far from it.
+        """
+        ec = self.config.export
+        rc = self.config.resource
+        model = ShogiModel(self.config)
+        if not load_best_model_weight(model):
+            raise RuntimeError("Best model not found!")
+
+        float_path = onnx_model_path(rc, model.digest)
+        logger.info(f"export the best model to {float_path}")
+        # the folded model is only exported once folding is validated, see bench_fold_batchnorm.py
+        export_onnx(model.predict_only_model(model.model) if self.config.play.fold_batchnorm else model.model,
+                    float_path)
+        paths = [float_path]
+
+        calibration_states, check_states = self.sample_states(ec.calibration_positions, ec.check_positions)
+        if ec.quantize:
+            int8_path = onnx_model_path(rc, model.digest, int8=True)
+            logger.info(f"quantize the best model to {int8_path} with {len(calibration_states)} positions")
+            quantize_onnx(float_path, int8_path, calibration_states, ec.batch_size)
+            paths.append(int8_path)
+        remove_stale_onnx_models(rc, model.digest)
+
+        failed = []
+        for path in paths:
+            check = compare_predictions(model.model, OnnxNetwork(path), check_states, ec.batch_size)
+            logger.info(f"{path}: top-1 move agreement {check['top1_agreement'] * 100:.2f}% "
+                        f"value mse {check['value_mse']:.2e} on {len(check_states)} held-out positions")
+            if check["top1_agreement"] < ec.min_top1_agreement or check["value_mse"] > ec.max_value_mse:
+                failed.append(path)
+        if failed:
+            for path in paths:
+                os.remove(path)
+            raise RuntimeError(f"{', '.join(failed)} predict too far from the best model (top-1 move agreement "
+                               f"under {ec.min_top1_agreement * 100:.2f}% or value mse over {ec.max_value_mse:.2e}), "
+                               f"removed the exported models")
+
+    def sample_states(self, num_calibration, num_check):
+        """
+        Samples positions of the play data, from distinct files for the calibration and for the check, so
+        that the check is on positions of games the calibration did not see
+
+        :param int num_calibration: number of positions to calibrate on
+        :param int num_check: number of positions to check on
+        :return (np.ndarray,np.ndarray): input planes of the calibration positions and of the check positions
+        """
+        filenames = get_game_data_filenames(self.config.resource)
+        Random(0).shuffle(filenames)
+        samples = ([], num_calibration if self.config.export.quantize else 0), ([], num_check)
+        for filename in filenames:
+            unfilled = [states for states, num in samples if sum(map(len, states)) < num]
+            if not unfilled:
+                break
+            state_ary, _, _ = load_data_from_file(filename)
+            if state_ary is not None:
+                unfilled[0].append(state_ary)
+        calibration, check = [np.concatenate(states)[:num].astype(np.float32) if states else
+                              np.zeros((0, 44, 9, 9), dtype=np.float32) for states, num in samples]
+        if len(check) == 0:
+            raise RuntimeError("There is no play data to check the exported models on!")
+        return calibration, check
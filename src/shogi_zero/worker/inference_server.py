@@ -0,0 +1,106 @@
+"""
+Holds the worker which serves the predictions of the best model to all the self-play, evaluation and uci
+processes of this machine, so that they share one copy of the model and its batches fill up across processes.
+"""
+import os
+from logging import getLogger
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, answer_challenge, deliver_challenge
+from threading import Thread
+from time import sleep
+
+from shogi_zero.agent.model_shogi import ShogiModel
+from shogi_zero.config import Config
+from shogi_zero.lib.model_helper import load_best_model_weight, save_as_best_model, \
+    reload_best_model_weight_if_changed
+
+logger = getLogger(__name__)
+
+
+def start(config: Config):
+    return InferenceServerWorker(config).start()
+
+
+class InferenceServerWorker:
+    """
+    Worker which loads the best model once and accepts connections from the players of the workers which are
+    started with PlayConfig.use_inference_server. Each client sends the max number of observations of its
+    requests, and gets back the name of a shared memory slot (or None to use its connection only). The handshake
+    of each client, authentication included, runs in a thread of its own, so that a client which never completes
+    it does not hold up the others.
+
+    Attributes:
+        :ivar Config config: config to use to configure this worker
+        :ivar ShogiModel model: the best model, reloaded when it changes
+    """
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.model = self.load_model()
+
+    def start(self):
+        """
+        Accept connections from the clients until the process is killed
+        """
+        rc = self.config.resource
+        self.model.get_pipes(0)  # starts the api
+        Thread(target=self.reload_model, daemon=True).start()
+
+        if os.path.exists(rc.inference_server_address):
+            os.remove(rc.inference_server_address)  # left by a previous server which was killed
+        # the challenges are answered in handshake, as Listener.accept would wait for them
+        with Listener(rc.inference_server_address, family="AF_UNIX") as listener:
+            logger.info(f"inference server listening on {rc.inference_server_address}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except OSError as e:
+                    logger.warning(f"failed to accept a client: {e!r}")
+                    continue
+                Thread(target=self.handshake, args=(conn,), daemon=True).start()
+
+    def handshake(self, conn):
+        """
+        Authenticates a new client like Listener.accept, then gets the max number of observations of its
+        requests and starts serving it
+
+        :param Connection conn: connection to the client
+        """
+        authkey = self.config.resource.inference_server_authkey
+        try:
+            deliver_challenge(conn, authkey)
+            answer_challenge(conn, authkey)
+            max_batch_size = conn.recv()
+        except (AuthenticationError, EOFError, OSError) as e:
+            logger.warning(f"rejected a client: {e!r}")
+            conn.close()
+            return
+        name = self.model.api.add_connection(conn, max_batch_size)
+        try:
+            conn.send(name)
+        except OSError:  # the client went away, the api drops it as soon as it sees it
+            pass
+
+    def reload_model(self):
+        """
+        Reload the best model when it changes, and log the batches of the last interval
+        """
+        while True:
+            sleep(self.config.play.inference_server_reload_interval)
+            reload_best_model_weight_if_changed(self.model)
+            batch_stats = self.model.api.batch_stats.summary()
+            logger.debug(f"model server: clients={len(self.model.api.pipes)} batches={batch_stats['batches']} "
+                         f"mean size={batch_stats['mean_size']:.1f} sizes={batch_stats['histogram']} "
+                         f"queue wait={batch_stats['queue_wait'] * 1000:.2f}ms "
+                         f"model time={batch_stats['model_time'] * 1000:.2f}ms")
+
+    def load_model(self):
+        """
+        Load the current best model
+        :return ShogiModel: current best model
+        """
+        model = ShogiModel(self.config)
+        if self.config.opts.new or not load_best_model_weight(model):
+            model.build()
+            save_as_best_model(model)
+        return model
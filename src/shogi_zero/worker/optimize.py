@@ -2,24 +2,20 @@
 Encapsulates the worker which trains ShogiModels using game data from recorded games from a file.
 """
 import os
-from collections import deque, defaultdict
 from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from logging import getLogger
-from time import sleep
-from random import shuffle
-
-import numpy as np
+from time import time
 
 from shogi_zero.agent.model_shogi import ShogiModel
 from shogi_zero.config import Config
-#from shogi_zero.env.shogi_env import canon_input_planes, is_black_turn, testeval
-from shogi_zero.env.shogi_env import SfenInfo, CanonicalInput
-from shogi_zero.lib.data_helper import get_game_data_filenames, read_game_data_from_file, get_next_generation_model_dirs
+from shogi_zero.lib.data_helper import get_next_generation_model_dirs
 from shogi_zero.lib.model_helper import load_best_model_weight
+from shogi_zero.lib.shared_memory_helper import has_shared_memory
+from shogi_zero.lib.training_data import TrainingDataStream
 
 from keras.optimizers import Adam
-from keras.callbacks import TensorBoard
+from keras.callbacks import Callback, TensorBoard
 logger = getLogger(__name__)
 
 
@@ -38,63 +34,62 @@ class OptimizeWorker:
     Attributes:
         :ivar Config config: config for this worker
         :ivar ShogiModel model: model to train
-        :ivar dequeue,dequeue,dequeue dataset: tuple of dequeues where each dequeue contains game states,
-            target policy network values (calculated based on visit stats
-                for each state during the game), and target value network values (calculated based on
-                    who actually won the game after that state)
-        :ivar ProcessPoolExecutor executor: executor for running all of the training processes
+        :ivar ProcessPoolExecutor executor: processes which decode the game data files, for the whole training
+        :ivar TrainingDataStream stream: batches of game states, target policy network values (calculated based
+            on visit stats for each state during the game), and target value network values (calculated based on
+            who actually won the game after that state)
     """
 
     def __init__(self, config: Config):
         self.config = config
         self.model = None  # type: ShogiModel
-        self.dataset = deque(), deque(), deque()
+        if has_shared_memory():
+            from multiprocessing import resource_tracker  # Python 3.8+
+            resource_tracker.ensure_running()  # shared by the processes, which pass blocks of shared memory along
         self.executor = ProcessPoolExecutor(max_workers=config.trainer.cleaning_processes)
+        self.stream = TrainingDataStream(config, self.executor)
 
     def start(self):
         """
         Load the next generation model from disk and start doing the training endlessly.
         """
         self.model = self.load_model()
-        self.training()
+        try:
+            self.training()
+        finally:
+            self.stream.close()
 
     def training(self):
         """
         Does the actual training of the model, running it on game data. Endless.
         """
         self.compile_model()
-        self.filenames = deque(get_game_data_filenames(self.config.resource))
-        shuffle(self.filenames)
         total_steps = self.config.trainer.start_total_steps
+        state_ary, policy_ary, value_ary = self.stream.take_held_out(self.config.trainer.validation_size)
+        validation_data = (state_ary, [policy_ary, value_ary])
 
         while True:
-            self.fill_queue()
-            steps = self.train_epoch(self.config.trainer.epoch_to_checkpoint)
+            steps = self.train_epoch(self.config.trainer.epoch_to_checkpoint, validation_data)
             total_steps += steps
             self.save_current_model()
-            a, b, c = self.dataset
-            while len(a) > self.config.trainer.dataset_size / 2:
-                a.popleft()
-                b.popleft()
-                c.popleft()
 
-    def train_epoch(self, epochs):
+    def train_epoch(self, epochs, validation_data):
         """
-        Runs some number of epochs of training
+        Runs some number of epochs of training, of TrainerConfig.dataset_size positions each, from the stream
         :param int epochs: number of epochs
-        :return: number of datapoints that were trained on in total
+        :param (np.ndarray,list(np.ndarray)) validation_data: positions to validate on, from the files held
+            out of the training
+        :return: number of steps (batches) that were trained on in total
         """
         tc = self.config.trainer
-        state_ary, policy_ary, value_ary = self.collect_all_loaded_data()
+        steps_per_epoch = tc.dataset_size // tc.batch_size
         tensorboard_cb = TensorBoard(log_dir="./logs", batch_size=tc.batch_size, histogram_freq=1)
-        self.model.model.fit(state_ary, [policy_ary, value_ary],
-                             batch_size=tc.batch_size,
-                             epochs=epochs,
-                             shuffle=True,
-                             validation_split=0.02,
-                             callbacks=[tensorboard_cb])
-        steps = (state_ary.shape[0] // tc.batch_size) * epochs
-        return steps
+        self.model.model.fit_generator(self.stream,
+                                       steps_per_epoch=steps_per_epoch,
+                                       epochs=epochs,
+                                       validation_data=validation_data,
+                                       callbacks=[DataWaitLogger(), tensorboard_cb])
+        return steps_per_epoch * epochs
 
     def compile_model(self):
         """
@@ -116,40 +111,6 @@ class OptimizeWorker:
         weight_path = os.path.join(model_dir, rc.next_generation_model_weight_filename)
         self.model.save(config_path, weight_path)
 
-    def fill_queue(self):
-        """
-        Fills the self.dataset queues with data from the training dataset.
-        """
-        futures = deque()
-        with ProcessPoolExecutor(max_workers=self.config.trainer.cleaning_processes) as executor:
-            for _ in range(self.config.trainer.cleaning_processes):
-                if len(self.filenames) == 0:
-                    break
-                filename = self.filenames.popleft()
-                logger.debug(f"loading data from {filename}")
-                futures.append(executor.submit(load_data_from_file, filename))
-            while futures and len(self.dataset[0]) < self.config.trainer.dataset_size:
-                for x, y in zip(self.dataset, futures.popleft().result()):
-                    if y is not None:
-                        x.extend(y)
-                if len(self.filenames) > 0:
-                    filename = self.filenames.popleft()
-                    logger.debug(f"loading data from {filename}")
-                    futures.append(executor.submit(load_data_from_file, filename))
-
-    def collect_all_loaded_data(self):
-        """
-
-        :return: a tuple containing the data in self.dataset, split into
-        (state, policy, and value).
-        """
-        state_ary, policy_ary, value_ary = self.dataset
-
-        state_ary1 = np.asarray(state_ary, dtype=np.float32)
-        policy_ary1 = np.asarray(policy_ary, dtype=np.float32)
-        value_ary1 = np.asarray(value_ary, dtype=np.float32)
-        return state_ary1, policy_ary1, value_ary1
-
     def load_model(self):
         """
         Loads the next generation model from the appropriate directory. If not found, loads
@@ -172,44 +133,30 @@ class OptimizeWorker:
         return model
 
 
-def load_data_from_file(filename):
-    data = read_game_data_from_file(filename)
-    try:
-        return convert_to_cheating_data(data)
-    except KeyError as e:
-        return None, None, None
-    except TypeError as e:
-        return None, None, None
-
-
-def convert_to_cheating_data(data):
+class DataWaitLogger(Callback):
     """
-    :param data: format is SelfPlayWorker.buffer
-    :return:
+    Logs how long the training waited for the batches during each epoch, and adds it to the logs of the epoch
+    (data_wait in seconds, data_wait_ratio of the time of the epoch) for the callbacks after it, e.g. TensorBoard.
+
+    Attributes:
+        :ivar float epoch_start: time the epoch started
+        :ivar float batch_end: time the last batch was trained on
+        :ivar float wait: time spent waiting for the batches in the epoch so far
     """
-    state_list = []
-    policy_list = []
-    value_list = []
-    map_count_state = defaultdict(int)
-    for aaa in data:
-        state_sfen, policy, value = aaa
-        sfen_info = SfenInfo(state_sfen)
-        map_count_state[sfen_info.board] += 1
-        same_state_count = map_count_state[sfen_info.board]
-        if sfen_info.turn == 'w':
-            sfen_info = sfen_info.get_flipped_sfen_info()
-
-        canonical_input = CanonicalInput(sfen_info, same_state_count)
-        state_planes = canonical_input.create()
-        if sfen_info.turn == 'w':
-            policy = Config.flip_policy(policy)
-
-        move_number = int(state_sfen.split(' ')[3])
-        value_certainty = min(5, move_number) / 5  # reduces the noise of the opening... plz train faster
-        sl_value = value * value_certainty
-
-        state_list.append(state_planes)
-        policy_list.append(policy)
-        value_list.append(sl_value)
-
-    return np.asarray(state_list, dtype=np.float32), np.asarray(policy_list, dtype=np.float32), np.asarray(value_list, dtype=np.float32)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = self.batch_end = time()
+        self.wait = 0.0
+
+    def on_batch_begin(self, batch, logs=None):
+        self.wait += time() - self.batch_end
+
+    def on_batch_end(self, batch, logs=None):
+        self.batch_end = time()
+
+    def on_epoch_end(self, epoch, logs=None):
+        ratio = self.wait / max(time() - self.epoch_start, 1e-9)
+        logger.info(f"epoch {epoch + 1}: waited {self.wait:.1f}s for the training data ({ratio * 100:.1f}%)")
+        if logs is not None:
+            logs["data_wait"] = self.wait
+            logs["data_wait_ratio"] = ratio
@@ -6,10 +6,10 @@ from collections import deque
 from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from logging import getLogger
-from multiprocessing import Manager
 from threading import Thread
 from time import time
 
+from shogi_zero.agent.api_shogi import connect_to_server
 from shogi_zero.agent.model_shogi import ShogiModel
 from shogi_zero.agent.player_shogi import ShogiPlayer
 from shogi_zero.config import Config
@@ -17,6 +17,7 @@ from shogi_zero.env.shogi_env import ShogiEnv, Winner
 from shogi_zero.lib.data_helper import get_game_data_filenames, write_game_data_to_file, pretty_print
 from shogi_zero.lib.model_helper import load_best_model_weight, save_as_best_model, \
     reload_best_model_weight_if_changed
+from shogi_zero.lib.pipe_helper import share_pipes, worker_pipes
 
 logger = getLogger(__name__)
 
@@ -33,20 +34,21 @@ class SelfPlayWorker:
 
     Attributes:
         :ivar Config config: config to use to configure this worker
-        :ivar ShogiModel current_model: model to use for self play
-        :ivar Manager m: the manager to use to coordinate between other workers
-        :ivar list(Connection) cur_pipes: pipes to send observations to and get back mode predictions.
-        :ivar list((str,list(float))): list of all the moves. Each tuple has the observation in FEN format and
-            then the list of prior probabilities for each action, given by the visit count of each of the states
-            reached by the action (actions indexed according to how they are ordered in the uci move list).
+        :ivar ShogiModel current_model: model to use for self play, None with PlayConfig.use_inference_server
+        :ivar Thread reload_thread: thread which reloads the best model if it changed, None before the first time
+        :ivar list(list(Connection)) cur_pipes: pipes to send observations to and get back mode predictions,
+            one group of search_threads pipes per self-play process.
+        :ivar list((str,(np.ndarray,np.ndarray),float)) buffer: list of all the moves. Each has the observation in
+            FEN format, then the sparse policy: the label indices (uint16, indexed according to how they are ordered
+            in the uci move list) of the actions with a non-zero probability and their probabilities (float32),
+            given by the visit count of each of the states reached by the action, and the game result.
     """
 
     def __init__(self, config: Config):
         self.config = config
-        self.current_model = self.load_model()
-        self.m = Manager()
-        self.cur_pipes = self.m.list([self.current_model.get_pipes(self.config.play.search_threads)
-                                      for _ in range(self.config.play.max_processes)])
+        self.current_model = None if self.config.play.use_inference_server else self.load_model()
+        self.reload_thread = None
+        self.cur_pipes = [self.get_pipes() for _ in range(self.config.play.max_processes)]
         self.buffer = []
 
     def start(self):
@@ -56,25 +58,59 @@ class SelfPlayWorker:
         self.buffer = []
 
         futures = deque()
+        share_pipes({"cur": self.cur_pipes})
         with ProcessPoolExecutor(max_workers=self.config.play.max_processes) as executor:
             for game_idx in range(self.config.play.max_processes):
-                futures.append(executor.submit(self_play_buffer, self.config, cur=self.cur_pipes))
+                futures.append(executor.submit(self_play_buffer, self.config))
             game_idx = 0
             while True:
                 game_idx += 1
                 start_time = time()
-                env, data = futures.popleft().result()
+                env, data, search_stats = futures.popleft().result()
                 logger.info(f"game {game_idx:3} time={time() - start_time:5.1f}s "
                             f"halfmoves={env.num_halfmoves:3} {env.winner:12} "
-                            f"{'by resign ' if env.resigned else '          '}")
+                            f"{'by resign ' if env.resigned else '          '}"
+                            f"evaluations={search_stats['evaluations']} cache hits={search_stats['cache_hits']} "
+                            f"opening cache hits={search_stats['opening_cache_hits']} "
+                            f"reused nodes={search_stats['reused_nodes']} visits={search_stats['reused_visits']}")
+                if "cache" in search_stats:
+                    cache_stats = search_stats["cache"]
+                    logger.debug(f"evaluation cache: hit_rate={cache_stats['hit_rate'] * 100:5.1f}% "
+                                 f"entries={cache_stats['entries']} memory={cache_stats['bytes'] / 2 ** 20:.1f}MiB")
+                if self.current_model is not None:
+                    batch_stats = self.current_model.api.batch_stats.summary()
+                    logger.debug(f"model server: batches={batch_stats['batches']} "
+                                 f"mean size={batch_stats['mean_size']:.1f} sizes={batch_stats['histogram']} "
+                                 f"queue wait={batch_stats['queue_wait'] * 1000:.2f}ms "
+                                 f"model time={batch_stats['model_time'] * 1000:.2f}ms")
 
                 pretty_print(env, ("current_model", "current_model"))
                 self.buffer += data
                 if (game_idx % self.config.play_data.nb_game_in_file) == 0:
                     logger.debug('flash buffer {} {}'.format(game_idx, self.config.play_data.nb_game_in_file))
                     self.flush_buffer()
-                    reload_best_model_weight_if_changed(self.current_model)
-                futures.append(executor.submit(self_play_buffer, self.config, cur=self.cur_pipes))  # Keep it going
+                    if self.current_model is not None:  # else the inference server reloads it
+                        self.reload_model()
+                futures.append(executor.submit(self_play_buffer, self.config))  # Keep it going
+
+    def reload_model(self):
+        """
+        Reload the best model in the background if it changed, the games go on with the current weights meanwhile
+        """
+        if self.reload_thread is not None and self.reload_thread.is_alive():
+            return
+        self.reload_thread = Thread(target=reload_best_model_weight_if_changed, args=(self.current_model,),
+                                    daemon=True)
+        self.reload_thread.start()
+
+    def get_pipes(self):
+        """
+        Get the pipes of one self-play process, to its own model or to the inference server
+        :return list(Connection): search_threads pipes
+        """
+        if self.config.play.use_inference_server:
+            return connect_to_server(self.config.resource, self.config.play)
+        return self.current_model.get_pipes(self.config.play.search_threads)
 
     def load_model(self):
         """
@@ -110,20 +146,20 @@ class SelfPlayWorker:
             os.remove(files[i])
 
 
-def self_play_buffer(config, cur) -> (ShogiEnv, list):
+def self_play_buffer(config) -> (ShogiEnv, list, dict):
     """
-    Play one game and add the play data to the buffer
+    Play one game and add the play data to the buffer, with the pipes of this process to the current model
     :param Config config: config for how to play
-    :param list(Connection) cur: list of pipes to use to get a pipe to send observations to for getting
-        predictions. One will be removed from this list during the game, then added back
-    :return (ShogiEnv,list((str,list(float)): a tuple containing the final ShogiEnv state and then a list
-        of data to be appended to the SelfPlayWorker.buffer
+    :return (ShogiEnv,list((str,list(float)),dict(str,int)): a tuple containing the final ShogiEnv state, then a list
+        of data to be appended to the SelfPlayWorker.buffer, and the search stats of both players summed
     """
-    pipes = cur.pop()  # borrow
+    pipes = worker_pipes("cur")
     env = ShogiEnv().reset()
 
     white = ShogiPlayer(config, pipes=pipes)
     black = ShogiPlayer(config, pipes=pipes)
+    if config.play.share_tree:
+        black.share_tree_with(white)
 
     while not env.done:
         print(env.board)
@@ -153,5 +189,8 @@ def self_play_buffer(config, cur) -> (ShogiEnv, list):
         if i < len(black.moves):
             data.append(black.moves[i])
 
-    cur.append(pipes)
-    return env, data
+    search_stats = {k: white.search_stats[k] + black.search_stats[k] for k in white.search_stats}
+    if white.evaluation_cache is not None:
+        search_stats["cache"] = white.evaluation_cache.stats()
+
+    return env, data, search_stats
@@ -121,7 +121,8 @@ def _get_buffer(config, game, tot_num, idx):
     Gets data to load into the buffer by playing a game using PGN data.
     :param Config config: config to use to play the game
     :param pgn.Game game: game to play
-    :return list(str,list(float)): data from this game for the SupervisedLearningWorker.buffer
+    :return list(str,list(float)): data from this game for the SupervisedLearningWorker.buffer, None if a move
+        of the game is illegal
     """
     env = ShogiEnv().reset()
     white = ShogiPlayer(config, dummy=True)
@@ -132,6 +133,9 @@ def _get_buffer(config, game, tot_num, idx):
         else:
             action = black.sl_action(env.observation, move)  # ignore=True
         env.step(action, False)
+        if env.done:  # the move was rejected, and every move after it would be too
+            logger.debug(f"illegal move {action} in game {game['game_id']}")
+            return None, None, game['game_id']
 
     # this program define white as "Sente".
     if game['win'] == "b":